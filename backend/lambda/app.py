@@ -1,49 +1,488 @@
+import ast
+import base64
+import hashlib
 import json
+import math
+import operator
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from os import environ
 
 import boto3
-from urllib.parse import urlparse
+import requests
+from botocore.config import Config
 
 from elasticsearch import Elasticsearch, RequestsHttpConnection
-from requests_aws4auth import AWS4Auth
+from elasticsearch.exceptions import ConnectionError as ESConnectionError, ConnectionTimeout
 
-# Global variables that are reused
-sm_runtime_client = boto3.client('sagemaker-runtime')
-s3_client = boto3.client('s3')
+# Per-call time budgets in seconds for the concurrent fan-out in the hybrid route
+EMBED_TIMEOUT = float(environ.get('EMBED_TIMEOUT', '10'))
+SEARCH_TIMEOUT = float(environ.get('SEARCH_TIMEOUT', '10'))
+FANOUT_WORKERS = int(environ.get('FANOUT_WORKERS', '4'))
 
+# Global variables that are reused. The SageMaker client is needed by most routes and is created during
+# init; clients and libraries used only by optional paths (SigV4, DynamoDB tier) load on first use.
+# profile_cold_start.py in the repository root reports and checks the init time of this module.
+# A single attempt: botocore retries read timeouts, so with retries every embedding call could hold
+# the invocation (and a fan-out thread) for a multiple of EMBED_TIMEOUT, past the 29 s API Gateway limit.
+sm_runtime_client = boto3.client('sagemaker-runtime', config=Config(
+    connect_timeout=EMBED_TIMEOUT, read_timeout=EMBED_TIMEOUT, retries={'total_max_attempts': 1}))
 
-def get_features(sm_runtime_client, sagemaker_endpoint, payload):
+# OpenSearch client settings. The client is created on first use and reused by every invocation
+# served by this execution environment, so TLS handshakes and connections are paid once.
+ES_PORT = int(environ.get('ES_PORT', '443'))
+ES_USE_SSL = environ.get('ES_USE_SSL', 'true').lower() == 'true'
+ES_AUTH = environ.get('ES_AUTH', 'basic').lower()  # basic or sigv4
+ES_POOL_SIZE = int(environ.get('ES_POOL_SIZE', '10'))
+ES_TIMEOUT = int(environ.get('ES_TIMEOUT', '30'))
+ES_MAX_RETRIES = int(environ.get('ES_MAX_RETRIES', '2'))
+
+es_client = None
+es_client_lock = threading.Lock()
+fanout_executor = ThreadPoolExecutor(max_workers=FANOUT_WORKERS)
+
+# Query-embedding cache. The in-process tier lives as long as the warm execution environment; the
+# optional shared tier (QUERY_CACHE_SHARED=dynamodb or file) is visible to every concurrent Lambda.
+QUERY_CACHE_SIZE = int(environ.get('QUERY_CACHE_SIZE', '1024'))
+QUERY_CACHE_TTL = int(environ.get('QUERY_CACHE_TTL', '3600'))
+QUERY_CACHE_SHARED = environ.get('QUERY_CACHE_SHARED', 'none').lower()
+QUERY_CACHE_TABLE = environ.get('QUERY_CACHE_TABLE', 'semantic-search-query-cache')
+QUERY_CACHE_DIR = environ.get('QUERY_CACHE_DIR', '/tmp/query-cache')
+METRICS_NAMESPACE = environ.get('METRICS_NAMESPACE', 'SemanticSearch/Backend')
+
+query_cache = None
+
+# Full-response cache for repeated searches; RESPONSE_CACHE_SIZE=0 turns it off
+RESPONSE_CACHE_SIZE = int(environ.get('RESPONSE_CACHE_SIZE', '512'))
+RESPONSE_CACHE_TTL = int(environ.get('RESPONSE_CACHE_TTL', '600'))
+GENERATION_REFRESH = float(environ.get('GENERATION_REFRESH', '10'))
+
+response_cache = None
+
+# Batch route: search strings accepted in one /postBatch request
+MAX_BATCH_QUERIES = int(environ.get('MAX_BATCH_QUERIES', '50'))
+
+# Pagination: the page size a request may ask for, and the fields fetched for every hit. Sorting on
+# _score with the question_id keyword as tie-breaker gives every hit the sort values a search_after
+# cursor needs. question_id is read from doc values; sorting on _id would build fielddata on every shard.
+# unmapped_type keeps indexes created before the field existed searchable, without a stable tie-break.
+DEFAULT_PAGE_SIZE = int(environ.get('DEFAULT_PAGE_SIZE', '30'))
+MAX_PAGE_SIZE = int(environ.get('MAX_PAGE_SIZE', '100'))
+SEARCH_FIELDS = ['question', 'answer']
+PAGE_SORT = [{'_score': 'desc'}, {'question_id': {'order': 'asc', 'unmapped_type': 'keyword'}}]
+
+# Optional exact second stage for kNN: RESCORE_FACTOR > 1 fetches k * RESCORE_FACTOR approximate
+# candidates and reorders them by exact cosine similarity on the full-precision vectors kept in
+# _source under RESCORE_VECTOR_FIELD, so the ANN field itself can hold a compressed vector.
+RESCORE_FACTOR = int(environ.get('RESCORE_FACTOR', '0'))
+RESCORE_VECTOR_FIELD = environ.get('RESCORE_VECTOR_FIELD', 'question_vector')
+
+# Hybrid route: fusion is 'rrf' (reciprocal-rank fusion) or 'score' (min-max normalized score sum)
+HYBRID_FUSION = environ.get('HYBRID_FUSION', 'rrf').lower()
+HYBRID_SEMANTIC_WEIGHT = float(environ.get('HYBRID_SEMANTIC_WEIGHT', '1.0'))
+HYBRID_LEXICAL_WEIGHT = float(environ.get('HYBRID_LEXICAL_WEIGHT', '1.0'))
+HYBRID_RRF_K = int(environ.get('HYBRID_RRF_K', '60'))
+HYBRID_CANDIDATE_FACTOR = int(environ.get('HYBRID_CANDIDATE_FACTOR', '2'))
+
+# Response formats the encoder endpoint can return, see code/inference.py:output_fn
+JSON_CONTENT_TYPE = 'application/json'
+NPY_CONTENT_TYPE = 'application/x-npy'
+FLOAT16_JSON_CONTENT_TYPE = 'application/x-float16+json'
+NPY_DTYPES = {'<f2': 'e', '<f4': 'f', '<f8': 'd'}
+
+
+def reshape(values, shape):
+    if len(shape) == 1:
+        return list(values)
+    dim = shape[-1]
+    return [list(values[i:i + dim]) for i in range(0, len(values), dim)]
+
+
+def decode_npy(body):
+    if body[:6] != b'\x93NUMPY':
+        raise ValueError('Response body is not a .npy array')
+    if body[6] == 1:
+        header_len, offset = struct.unpack('<H', body[8:10])[0], 10
+    else:
+        header_len, offset = struct.unpack('<I', body[8:12])[0], 12
+    header = ast.literal_eval(body[offset:offset + header_len].decode('latin1'))
+    data = body[offset + header_len:]
+    code = NPY_DTYPES[header['descr']]
+    values = struct.unpack('<%d%s' % (len(data) // struct.calcsize(code), code), data)
+    return reshape(values, header['shape'])
+
+
+def decode_float16_json(body):
+    response_body = json.loads(body)
+    data = base64.b64decode(response_body['data'])
+    values = struct.unpack('<%de' % (len(data) // 2), data)
+    return reshape(values, response_body['shape'])
+
+
+def decode_embeddings(body, content_type):
+    mime_type = (content_type or JSON_CONTENT_TYPE).split(';')[0].strip().lower()
+    if mime_type == NPY_CONTENT_TYPE:
+        return decode_npy(body)
+    if mime_type == FLOAT16_JSON_CONTENT_TYPE:
+        return decode_float16_json(body)
+    return json.loads(body)
+
+
+class PooledRequestsHttpConnection(RequestsHttpConnection):
+    # RequestsHttpConnection with a keep-alive pool sized for the concurrent requests of one invocation
+    def __init__(self, *args, **kwargs):
+        pool_maxsize = kwargs.pop('pool_maxsize', ES_POOL_SIZE)
+        super(PooledRequestsHttpConnection, self).__init__(*args, **kwargs)
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+
+class RefreshingAWS4Auth(requests.auth.AuthBase):
+    # SigV4 signer that re-reads the session credentials only when they have been rotated.
+    # get_frozen_credentials refreshes temporary credentials shortly before they expire.
+    def __init__(self, region, service='es'):
+        self.credentials = boto3.session.Session().get_credentials()
+        self.region = region
+        self.service = service
+        self.auth = None
+        self.key = None
+
+    def __call__(self, request):
+        from requests_aws4auth import AWS4Auth
+        credentials = self.credentials.get_frozen_credentials()
+        key = (credentials.access_key, credentials.token)
+        if key != self.key:
+            self.auth = AWS4Auth(credentials.access_key, credentials.secret_key, self.region, self.service,
+                                 session_token=credentials.token)
+            self.key = key
+        return self.auth(request)
+
+
+def es_auth():
+    if ES_AUTH == 'sigv4':
+        return RefreshingAWS4Auth(environ['AWS_REGION'])
+    return (environ.get('ES_USER', 'master'), environ.get('ES_PASSWORD', 'Semantic123!'))
+
+
+def get_es_client():
+    global es_client
+    with es_client_lock:
+        if es_client is None:
+            es_client = Elasticsearch(
+                hosts=[{'host': environ['ES_ENDPOINT'], 'port': ES_PORT}],
+                http_auth=es_auth(),
+                use_ssl=ES_USE_SSL,
+                verify_certs=True,
+                connection_class=PooledRequestsHttpConnection,
+                timeout=ES_TIMEOUT,
+                # A search that timed out is not retried: every attempt costs a full request
+                # timeout, and the API Gateway limit is 29 s
+                max_retries=ES_MAX_RETRIES,
+                retry_on_timeout=False
+            )
+        return es_client
+
+
+def reset_es_client():
+    global es_client
+    with es_client_lock:
+        if es_client is not None:
+            es_client.transport.close()
+        es_client = None
+
+
+def with_es_client(search):
+    try:
+        return search(get_es_client())
+    except ConnectionTimeout:
+        # A subclass of ConnectionError, but a slow cluster is not a stale connection
+        raise
+    except ESConnectionError:
+        # Pooled connections can go stale while the execution environment is frozen; reconnect once
+        reset_es_client()
+        return search(get_es_client())
+
+
+class TTLCache(object):
+    # LRU with a time-to-live per entry
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, vector):
+        with self.lock:
+            self.entries[key] = (time.time() + self.ttl, vector)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+def pack_vector(vector):
+    return struct.pack('<%df' % len(vector), *vector)
+
+
+def unpack_vector(data):
+    return list(struct.unpack('<%df' % (len(data) // 4), data))
+
+
+class DynamoDBVectorStore(object):
+    # Shared tier in a DynamoDB table with a string partition key 'key'. Enable TTL on 'expires_at'
+    # so expired items are also removed from the table.
+    def __init__(self, table_name, ttl):
+        self.table_name = table_name
+        self.ttl = ttl
+        self.client = boto3.client('dynamodb')
+
+    def get(self, key):
+        item = self.client.get_item(TableName=self.table_name, Key={'key': {'S': key}}).get('Item')
+        if item is None or int(item['expires_at']['N']) < time.time():
+            return None
+        return unpack_vector(item['vector']['B'])
+
+    def put(self, key, vector):
+        self.client.put_item(TableName=self.table_name, Item={
+            'key': {'S': key},
+            'vector': {'B': pack_vector(vector)},
+            'expires_at': {'N': str(int(time.time() + self.ttl))}})
+
+
+class FileVectorStore(object):
+    # Stand-in for the shared tier when running locally: one file per key in a directory
+    def __init__(self, directory, ttl):
+        self.directory = directory
+        self.ttl = ttl
+        os.makedirs(directory, exist_ok=True)
+
+    def get(self, key):
+        path = os.path.join(self.directory, key)
+        try:
+            if os.path.getmtime(path) + self.ttl < time.time():
+                return None
+            with open(path, 'rb') as f:
+                return unpack_vector(f.read())
+        except OSError:
+            return None
+
+    def put(self, key, vector):
+        path = os.path.join(self.directory, key)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(pack_vector(vector))
+        os.replace(path + '.tmp', path)
+
+
+class QueryEmbeddingCache(object):
+    def __init__(self, local, shared=None):
+        self.local = local
+        self.shared = shared
+        self.counts = {'QueryCacheLocalHit': 0, 'QueryCacheSharedHit': 0, 'QueryCacheMiss': 0}
+
+    # The endpoint name is part of the key, so pointing SM_ENDPOINT at a new model starts a fresh cache
+    def key(self, sagemaker_endpoint, payload):
+        text = ' '.join(payload.split())
+        return hashlib.sha1((sagemaker_endpoint + '\0' + text).encode('utf-8')).hexdigest()
+
+    def get_or_compute(self, sagemaker_endpoint, payload, compute):
+        key = self.key(sagemaker_endpoint, payload)
+        vector = self.local.get(key)
+        if vector is not None:
+            self.counts['QueryCacheLocalHit'] += 1
+            return vector
+        if self.shared is not None:
+            try:
+                vector = self.shared.get(key)
+            except Exception as e:
+                print('Shared query cache read failed: {}'.format(e))
+            if vector is not None:
+                self.counts['QueryCacheSharedHit'] += 1
+                self.local.put(key, vector)
+                return vector
+        self.counts['QueryCacheMiss'] += 1
+        vector = compute()
+        self.local.put(key, vector)
+        if self.shared is not None:
+            try:
+                self.shared.put(key, vector)
+            except Exception as e:
+                print('Shared query cache write failed: {}'.format(e))
+        return vector
+
+    # Looks up every payload and computes all misses with one call; repeated payloads are computed once
+    def get_or_compute_many(self, sagemaker_endpoint, payloads, compute_many):
+        keys = [self.key(sagemaker_endpoint, payload) for payload in payloads]
+        vectors = {}
+        misses = OrderedDict()
+        for key, payload in zip(keys, payloads):
+            if key in vectors or key in misses:
+                continue
+            vector = self.local.get(key)
+            if vector is not None:
+                self.counts['QueryCacheLocalHit'] += 1
+            elif self.shared is not None:
+                try:
+                    vector = self.shared.get(key)
+                except Exception as e:
+                    print('Shared query cache read failed: {}'.format(e))
+                if vector is not None:
+                    self.counts['QueryCacheSharedHit'] += 1
+                    self.local.put(key, vector)
+            if vector is None:
+                misses[key] = payload
+            else:
+                vectors[key] = vector
+        if misses:
+            self.counts['QueryCacheMiss'] += len(misses)
+            for key, vector in zip(misses, compute_many(list(misses.values()))):
+                vectors[key] = vector
+                self.local.put(key, vector)
+                if self.shared is not None:
+                    try:
+                        self.shared.put(key, vector)
+                    except Exception as e:
+                        print('Shared query cache write failed: {}'.format(e))
+        return [vectors[key] for key in keys]
+
+    def pop_counts(self):
+        counts = self.counts
+        self.counts = dict.fromkeys(counts, 0)
+        return counts
+
+
+def get_query_cache():
+    global query_cache
+    if query_cache is None:
+        shared = None
+        if QUERY_CACHE_SHARED == 'dynamodb':
+            shared = DynamoDBVectorStore(QUERY_CACHE_TABLE, QUERY_CACHE_TTL)
+        elif QUERY_CACHE_SHARED == 'file':
+            shared = FileVectorStore(QUERY_CACHE_DIR, QUERY_CACHE_TTL)
+        query_cache = QueryEmbeddingCache(TTLCache(QUERY_CACHE_SIZE, QUERY_CACHE_TTL), shared)
+    return query_cache
+
+
+class ResponseCache(object):
+    # Serialized response bodies keyed by route, normalized search string, page and index generation.
+    # The generation is the index uuid plus a counter in the _meta of the index mapping bumped by
+    # ingest_pqa.py, so neither a re-ingested nor a recreated index serves old entries. It is re-read at
+    # most every GENERATION_REFRESH seconds.
+    def __init__(self, max_entries, ttl, index_name='nlp_pqa'):
+        self.entries = TTLCache(max_entries, ttl)
+        self.index_name = index_name
+        self.current_generation = None
+        self.generation_checked = 0.0
+
+    def generation(self):
+        if time.time() - self.generation_checked >= GENERATION_REFRESH:
+            try:
+                index = next(iter(with_es_client(lambda es: es.indices.get(index=self.index_name, request_timeout=SEARCH_TIMEOUT)).values()))
+                meta = index['mappings'].get('_meta', {})
+                # The counter restarts when the index is deleted and recreated; the index uuid does not repeat
+                self.current_generation = (index['settings']['index']['uuid'], int(meta.get('generation', 0)))
+            except Exception as e:
+                # Without a known generation nothing is served from or stored in the cache
+                print('Reading the index generation failed: {}'.format(e))
+                self.current_generation = None
+            self.generation_checked = time.time()
+        return self.current_generation
+
+    def key(self, path, api_payload, k, cursor, generation):
+        if 'searchStrings' in api_payload:
+            text = json.dumps([' '.join(payload.split()) for payload in api_payload['searchStrings']])
+        else:
+            text = ' '.join(api_payload['searchString'].split())
+        options = json.dumps([api_payload.get('fusion'), api_payload.get('weights'), api_payload.get('lexical')], sort_keys=True)
+        return (path, text, k, cursor, options, generation)
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def put(self, key, body):
+        self.entries.put(key, body)
+
+
+def get_response_cache():
+    global response_cache
+    if response_cache is None:
+        response_cache = ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL)
+    return response_cache
+
+
+def emit_metrics(values, units):
+    # CloudWatch embedded metric format: the log line becomes metrics without a PutMetricData call
+    print(json.dumps(dict(values, _aws={
+        'Timestamp': int(time.time() * 1000),
+        'CloudWatchMetrics': [{
+            'Namespace': METRICS_NAMESPACE,
+            'Dimensions': [[]],
+            'Metrics': [{'Name': name, 'Unit': units.get(name, 'Count')} for name in values]}]})))
+
+
+def query_features(sagemaker_endpoint, payload, accept):
+    start_time = time.perf_counter()
+    cache = get_query_cache()
+    features = cache.get_or_compute(sagemaker_endpoint, payload,
+                                    lambda: get_features(sm_runtime_client, sagemaker_endpoint, payload, accept))
+    emit_metrics(dict(cache.pop_counts(), QueryEmbeddingLatency=(time.perf_counter() - start_time) * 1000),
+                 {'QueryEmbeddingLatency': 'Milliseconds'})
+    return features
+
+
+def query_features_batch(sagemaker_endpoint, payloads, accept):
+    start_time = time.perf_counter()
+    cache = get_query_cache()
+    features = cache.get_or_compute_many(sagemaker_endpoint, payloads,
+                                         lambda misses: get_batch_features(sm_runtime_client, sagemaker_endpoint, misses, accept))
+    emit_metrics(dict(cache.pop_counts(), QueryEmbeddingLatency=(time.perf_counter() - start_time) * 1000),
+                 {'QueryEmbeddingLatency': 'Milliseconds'})
+    return features
+
+
+def get_batch_features(sm_runtime_client, sagemaker_endpoint, payloads, accept=JSON_CONTENT_TYPE):
+    # A JSON list is encoded by the endpoint in one forward pass and comes back as one row per string
+    response = sm_runtime_client.invoke_endpoint(
+        EndpointName=sagemaker_endpoint,
+        ContentType=JSON_CONTENT_TYPE,
+        Accept=accept,
+        Body=json.dumps(payloads))
+    return decode_embeddings(response['Body'].read(), response.get('ContentType', accept))
+
+
+def get_features(sm_runtime_client, sagemaker_endpoint, payload, accept=JSON_CONTENT_TYPE):
     response = sm_runtime_client.invoke_endpoint(
         EndpointName=sagemaker_endpoint,
         ContentType='text/plain',
+        Accept=accept,
         Body=payload)
-    response_body = json.loads((response['Body'].read()))
-    features = response_body
+    features = decode_embeddings(response['Body'].read(), response.get('ContentType', accept))
 
     return features
 
 
-def get_neighbors(features, es, k_neighbors=30):
-    idx_name = 'nlp_pqa'
-    res = es.search(
-        request_timeout=30, index=idx_name,
-        body={
-            'size': k_neighbors,
-            'query': {'knn': {'question_vector': {'vector': features, 'k': k_neighbors}}}},
-        stored_fields=["question","answer"]
-        )
-    results = [{'question':res['hits']['hits'][x]['fields']['question'][0],
-            'answer':res['hits']['hits'][x]['fields']['answer'][0]} for x in range(k_neighbors)]
-    return results
+def knn_query_body(features, k_neighbors, size=None, search_after=None):
+    # k is the candidate depth per shard, so it has to cover every page up to the requested one
+    return page_body({'query': {'knn': {'question_vector': {'vector': features, 'k': k_neighbors}}}},
+                     size or k_neighbors, search_after)
 
 
-def es_match_query(payload, es, k=30):
-    idx_name = 'nlp_pqa'
-    search_body = {
-        "size": 30,
-        "_source": {
-            "excludes": ["question_vector"]
-        },
+def match_query_body(payload, size, search_after=None):
+    return page_body({
         "highlight": {
             "fields": {
                 "question": {}
@@ -56,73 +495,313 @@ def es_match_query(payload, es, k=30):
                 }
             }
         }
-    }
+    }, size, search_after)
 
-    search_response = es.search(request_timeout=30, index=idx_name,
-                                body=search_body)['hits']['hits'][:k]
-    response = [{'question': x['highlight']['question'], 'answer': x['_source']['answer']} for x in search_response]
-    return response
 
+def page_body(body, size, search_after=None):
+    # question and answer are stored fields in the nlp_pqa mapping, so _source (which holds the
+    # question_vector) is never loaded, and shards skip counting total hits
+    body.update({
+        'size': size,
+        '_source': False,
+        'stored_fields': SEARCH_FIELDS,
+        'track_total_hits': False,
+        'sort': PAGE_SORT})
+    if search_after is not None:
+        body['search_after'] = search_after
+    return body
 
 
-def lambda_handler(event, context):
+def encode_cursor(after, seen):
+    return base64.urlsafe_b64encode(json.dumps({'after': after, 'seen': seen}).encode('utf-8')).decode('ascii')
 
-    # elasticsearch variables
-    service = 'es'
-    region = environ['AWS_REGION']
-    elasticsearch_endpoint = environ['ES_ENDPOINT']
-
-    session = boto3.session.Session()
-    credentials = session.get_credentials()
-    # awsauth = AWS4Auth(
-    #     credentials.access_key,
-    #     credentials.secret_key,
-    #     region,
-    #     service,
-    #     session_token=credentials.token
-    #     )
-    awsauth=("master","Semantic123!")
-
-    es = Elasticsearch(
-        hosts=[{'host': elasticsearch_endpoint, 'port': 443}],
-        http_auth=awsauth,
-        use_ssl=True,
-        verify_certs=True,
-        connection_class=RequestsHttpConnection
-    )
 
-    # sagemaker variables
-    sagemaker_endpoint = environ['SM_ENDPOINT']
+def decode_cursor(cursor):
+    if not cursor:
+        return None, 0
+    state = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    return state['after'], state['seen']
 
-    api_payload = json.loads(event['body'])
-    k = 30
-    payload = api_payload['searchString']
 
-    if event['path'] == '/postText':
-        features = get_features(sm_runtime_client, sagemaker_endpoint, payload)
-        similiar_questions = get_neighbors(features, es, k_neighbors=k)
+def hit_field(hit, name):
+    return hit['fields'][name][0]
+
+
+def knn_candidates_body(features, k, search_after=None, vector_field=None, size=None):
+    body = knn_query_body(features, k, size or k, search_after)
+    if vector_field:
+        body['_source'] = {'includes': [vector_field]}
+    return body
+
+
+def knn_candidates(features, es, k, search_after=None, vector_field=None, timeout=SEARCH_TIMEOUT, size=None):
+    idx_name = 'nlp_pqa'
+    body = knn_candidates_body(features, k, search_after, vector_field, size)
+    return es.search(request_timeout=timeout, index=idx_name, body=body)['hits']['hits']
+
+
+def rescore_hits(features, hits, vector_field=RESCORE_VECTOR_FIELD):
+    # Exact cosine similarity against the full-precision vectors, highest first. Plain Python like the
+    # embedding decoders, so the deployment package has no native wheels to match to the Lambda platform.
+    query_norm = math.sqrt(sum(value * value for value in features))
+    rescored = []
+    for hit in hits:
+        vector = hit['_source'][vector_field]
+        norm = math.sqrt(sum(value * value for value in vector))
+        score = sum(map(operator.mul, vector, features)) / max(norm * query_norm, 1e-12)
+        rescored.append(dict(hit, _score=score))
+    return sorted(rescored, key=lambda hit: -hit['_score'])
+
+
+def two_stage_hits(features, es, k, offset=0, factor=RESCORE_FACTOR, timeout=SEARCH_TIMEOUT):
+    # Stage one oversamples approximate candidates, stage two reorders them exactly
+    candidates = knn_candidates(features, es, (offset + k) * factor, vector_field=RESCORE_VECTOR_FIELD, timeout=timeout)
+    return rescore_hits(features, candidates)[offset:offset + k]
+
+
+def get_neighbors(features, es, k_neighbors=30, cursor=None):
+    search_after, seen = decode_cursor(cursor)
+    if RESCORE_FACTOR > 1:
+        # Rescored pages are cut from the reordered candidate list, so the cursor is an offset only
+        hits = two_stage_hits(features, es, k_neighbors, seen)
+        after = None
+    else:
+        # k reaches past every earlier page, but only one page of hits after the cursor is returned
+        hits = knn_candidates(features, es, seen + k_neighbors, search_after, size=k_neighbors)
+        after = hits[-1]['sort'] if hits else None
+    results = [{'question': hit_field(hit, 'question'), 'answer': hit_field(hit, 'answer')} for hit in hits]
+    return results, encode_cursor(after, seen + len(hits)) if len(hits) == k_neighbors else None
+
+
+def es_match_query(payload, es, k=30, cursor=None):
+    idx_name = 'nlp_pqa'
+    search_after, seen = decode_cursor(cursor)
+    search_body = match_query_body(payload, k, search_after)
+
+    hits = es.search(request_timeout=SEARCH_TIMEOUT, index=idx_name, body=search_body)['hits']['hits']
+    response = [{'question': x['highlight']['question'] if 'highlight' in x else x['fields']['question'],
+                 'answer': hit_field(x, 'answer')} for x in hits]
+    return response, encode_cursor(hits[-1]['sort'], seen + len(hits)) if len(hits) == k else None
+
+
+def highlight_style(text):
+    return text.replace("<em>", '<em style="background-color:#f18973;">')
+
+
+def reciprocal_rank_fusion(ranked_lists, weights, rank_constant=HYBRID_RRF_K):
+    scores = {}
+    for hits, weight in zip(ranked_lists, weights):
+        for rank, hit in enumerate(hits, 1):
+            scores[hit['_id']] = scores.get(hit['_id'], 0.0) + weight / (rank_constant + rank)
+    return scores
+
+
+def normalized_score_fusion(ranked_lists, weights):
+    # Min-max normalizes each list so BM25 and cosine scores are comparable before weighting
+    scores = {}
+    for hits, weight in zip(ranked_lists, weights):
+        if not hits:
+            continue
+        low = min(hit['_score'] for hit in hits)
+        high = max(hit['_score'] for hit in hits)
+        for hit in hits:
+            normalized = (hit['_score'] - low) / (high - low) if high > low else 1.0
+            scores[hit['_id']] = scores.get(hit['_id'], 0.0) + weight * normalized
+    return scores
+
+
+def semantic_hits(features, es, k):
+    if RESCORE_FACTOR > 1:
+        return two_stage_hits(features, es, k, timeout=SEARCH_TIMEOUT)
+    return knn_candidates(features, es, k, timeout=SEARCH_TIMEOUT)
+
+
+def lexical_hits(payload, es, k):
+    idx_name = 'nlp_pqa'
+    return es.search(request_timeout=SEARCH_TIMEOUT, index=idx_name, body=match_query_body(payload, k))['hits']['hits']
+
+
+def fuse_hits(semantic, lexical, k=30, fusion=HYBRID_FUSION, weights=None):
+    semantic_weight, lexical_weight = weights or (HYBRID_SEMANTIC_WEIGHT, HYBRID_LEXICAL_WEIGHT)
+    if fusion == 'score':
+        scores = normalized_score_fusion([semantic, lexical], [semantic_weight, lexical_weight])
+    else:
+        scores = reciprocal_rank_fusion([semantic, lexical], [semantic_weight, lexical_weight])
+
+    documents = {}
+    for source, hits in (('semantic', semantic), ('lexical', lexical)):
+        for hit in hits:
+            document = documents.setdefault(hit['_id'], {
+                'question': hit_field(hit, 'question'), 'answer': hit_field(hit, 'answer'), 'sources': []})
+            document['sources'].append(source)
+            if 'highlight' in hit:
+                document['question'] = highlight_style(hit['highlight']['question'][0])
+    ranked = sorted(scores, key=scores.get, reverse=True)[:k]
+    return [dict(documents[doc_id], score=round(scores[doc_id], 6)) for doc_id in ranked]
+
+
+def remaining(deadline):
+    return max(0.0, deadline - time.perf_counter())
+
+
+def hybrid_query(payload, sagemaker_endpoint, accept, k=30, fusion=HYBRID_FUSION, weights=None):
+    # The embedding call and the BM25 search run concurrently; the kNN search starts as soon as the
+    # vector arrives. A retrieval that fails or misses its time budget is left out of the fusion and
+    # reported in 'errors', so the caller still gets the results of the other one.
+    candidates = k * HYBRID_CANDIDATE_FACTOR
+    start_time = time.perf_counter()
+    embedding = fanout_executor.submit(query_features, sagemaker_endpoint, payload, accept)
+    lexical = fanout_executor.submit(with_es_client, lambda es: lexical_hits(payload, es, candidates))
+    errors = {}
+    hits = {'semantic': [], 'lexical': []}
+
+    try:
+        features = embedding.result(timeout=EMBED_TIMEOUT)
+        semantic = fanout_executor.submit(with_es_client, lambda es: semantic_hits(features, es, candidates))
+        hits['semantic'] = semantic.result(timeout=SEARCH_TIMEOUT)
+    except FutureTimeoutError:
+        errors['semantic'] = 'timed out'
+    except Exception as e:
+        errors['semantic'] = str(e)
+
+    try:
+        hits['lexical'] = lexical.result(timeout=remaining(start_time + SEARCH_TIMEOUT))
+    except FutureTimeoutError:
+        errors['lexical'] = 'timed out'
+    except Exception as e:
+        errors['lexical'] = str(e)
+
+    if len(errors) == 2:
+        raise Exception('Hybrid search failed: {}'.format(json.dumps(errors)))
+    emit_metrics({'HybridLatency': (time.perf_counter() - start_time) * 1000, 'HybridPartial': int(bool(errors))},
+                 {'HybridLatency': 'Milliseconds'})
+    return fuse_hits(hits['semantic'], hits['lexical'], k, fusion, weights), errors
+
+
+def batch_query(payloads, features, es, k=30, lexical=False):
+    # Every kNN search (and BM25 search when asked for) goes out in one _msearch request; results come
+    # back in the order of the search strings. A failed search only marks its own entry, with
+    # semantic_error or lexical_error, so one failure does not hide the other.
+    idx_name = 'nlp_pqa'
+    rescore = RESCORE_FACTOR > 1
+    body = []
+    for payload, vector in zip(payloads, features):
+        if rescore:
+            body += [{'index': idx_name}, knn_candidates_body(vector, k * RESCORE_FACTOR, vector_field=RESCORE_VECTOR_FIELD)]
+        else:
+            body += [{'index': idx_name}, knn_query_body(vector, k)]
+        if lexical:
+            body += [{'index': idx_name}, match_query_body(payload, k)]
+    responses = iter(es.msearch(request_timeout=SEARCH_TIMEOUT, body=body)['responses'])
+
+    results = []
+    for payload, vector in zip(payloads, features):
+        result = {'searchString': payload}
+        response = next(responses)
+        if 'error' in response:
+            result['semantic_error'] = response['error']
+        else:
+            hits = response['hits']['hits']
+            if rescore:
+                hits = rescore_hits(vector, hits)[:k]
+            result['semantics'] = [{'question': hit_field(hit, 'question'), 'answer': hit_field(hit, 'answer')} for hit in hits]
+        if lexical:
+            response = next(responses)
+            if 'error' in response:
+                result['lexical_error'] = response['error']
+            else:
+                result['results'] = [{'question': [highlight_style(hit['highlight']['question'][0])] if 'highlight' in hit else hit['fields']['question'],
+                                      'answer': hit_field(hit, 'answer')} for hit in response['hits']['hits']]
+        results.append(result)
+    return results
+
+
+def http_response(body):
+    return {
+        "statusCode": 200,
+        "headers": {
+            "Access-Control-Allow-Origin":  "*",
+            "Access-Control-Allow-Headers": "*",
+            "Access-Control-Allow-Methods": "*"
+        },
+        "body": body,
+    }
+
+
+def search_route(path, api_payload, k, cursor, sagemaker_endpoint, sagemaker_accept):
+    # Returns the response body and whether it may be served from the response cache
+    payload = api_payload.get('searchString')
+
+    if path == '/postBatch':
+        payloads = api_payload['searchStrings']
+        if not payloads:
+            return {"batch": []}, True
+        features = query_features_batch(sagemaker_endpoint, payloads, sagemaker_accept)
+        results = with_es_client(lambda es: batch_query(payloads, features, es, k, bool(api_payload.get('lexical'))))
         return {
-            "statusCode": 200,
-            "headers": {
-                "Access-Control-Allow-Origin":  "*",
-                "Access-Control-Allow-Headers": "*",
-                "Access-Control-Allow-Methods": "*"
-            },
-            "body": json.dumps({
-                "semantics": similiar_questions,
-            }),
-        }
+            "batch": results,
+        }, not any('semantic_error' in result or 'lexical_error' in result for result in results)
+    elif path == '/postText':
+        features = query_features(sagemaker_endpoint, payload, sagemaker_accept)
+        similiar_questions, next_cursor = with_es_client(lambda es: get_neighbors(features, es, k_neighbors=k, cursor=cursor))
+        return {
+            "semantics": similiar_questions,
+            "searchAfter": next_cursor,
+        }, True
+    elif path == '/postHybrid':
+        weights = api_payload.get('weights') or {}
+        weights = (float(weights.get('semantic', HYBRID_SEMANTIC_WEIGHT)), float(weights.get('lexical', HYBRID_LEXICAL_WEIGHT)))
+        fusion = api_payload.get('fusion', HYBRID_FUSION)
+        results, errors = hybrid_query(payload, sagemaker_endpoint, sagemaker_accept, k, fusion, weights)
+        return {
+            "hybrid": results,
+            "partial": bool(errors),
+            "errors": errors,
+        }, not errors
     else:
-        search = es_match_query(payload, es, k)
+        search, next_cursor = with_es_client(lambda es: es_match_query(payload, es, k, cursor))
 
         for i in range(len(search)):
-            search[i]['question'][0] = search[i]['question'][0].replace("<em>",'<em style="background-color:#f18973;">')
+            search[i]['question'][0] = highlight_style(search[i]['question'][0])
         return {
-            "statusCode": 200,
-            "headers": {
-                "Access-Control-Allow-Origin":  "*",
-                "Access-Control-Allow-Headers": "*",
-                "Access-Control-Allow-Methods": "*"
-            },
-            "body": json.dumps(search),
-        }
+            "results": search,
+            "searchAfter": next_cursor,
+        }, True
+
+
+def validate_batch(payloads):
+    if not isinstance(payloads, list) or not all(isinstance(p, str) for p in payloads):
+        raise Exception('searchStrings must be a list of strings')
+    if len(payloads) > MAX_BATCH_QUERIES:
+        raise Exception('At most {} searchStrings are accepted per batch, got {}'.format(MAX_BATCH_QUERIES, len(payloads)))
+
+
+def lambda_handler(event, context):
+
+    # sagemaker variables
+    sagemaker_endpoint = environ['SM_ENDPOINT']
+    sagemaker_accept = environ.get('SM_ACCEPT', JSON_CONTENT_TYPE)
+
+    api_payload = json.loads(event['body'])
+    k = max(1, min(int(api_payload.get('size', DEFAULT_PAGE_SIZE)), MAX_PAGE_SIZE))
+    cursor = api_payload.get('searchAfter')
+    # Validated before the response cache key, which normalizes every search string
+    if event['path'] == '/postBatch':
+        validate_batch(api_payload['searchStrings'])
+
+    cache_key = None
+    if RESPONSE_CACHE_SIZE > 0:
+        cache = get_response_cache()
+        generation = cache.generation()
+        if generation is not None:
+            cache_key = cache.key(event['path'], api_payload, k, cursor, generation)
+            body = cache.get(cache_key)
+            emit_metrics({'ResponseCacheHit': int(body is not None)}, {})
+            if body is not None:
+                return http_response(body)
+
+    response_body, cacheable = search_route(event['path'], api_payload, k, cursor, sagemaker_endpoint, sagemaker_accept)
+    body = json.dumps(response_body)
+    if cache_key is not None and cacheable:
+        cache.put(cache_key, body)
+    return http_response(body)
@@ -0,0 +1,124 @@
+import argparse
+import itertools
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import time
+
+import convert_pqa
+from benchmark_stats import percentile
+
+# Offline throughput/latency benchmark of the encoder request path:
+# model_fn -> input_fn -> predict_fn -> output_fn, sweeping batch size, sequence length, thread count
+# and execution backend. Every configuration runs in a fresh process so the ENCODER_* settings and
+# the peak RSS are its own. Results are written as JSON to compare runs across commits.
+#
+#   python benchmark_encoder.py --model-dir transformer --corpus synthetic pqa \
+#       --batch-sizes 1 8 32 --seq-lengths 16 64 256 --threads 1 2 4 --backends eager onnx --output bench.json
+
+WORDS = ['does', 'this', 'headset', 'work', 'with', 'xbox', 'and', 'my', 'phone', 'battery', 'microphone', 'sound']
+
+def synthetic_sentences(seq_length, count, seed=0):
+    # Roughly one token per word, minus [CLS] and [SEP]
+    rng = random.Random(seed)
+    return [' '.join(rng.choice(WORDS) for _ in range(max(1, seq_length - 2))) for _ in range(count)]
+
+def run_config(config):
+    import inference
+    model = inference.model_fn(config['model_dir'])
+    if config['corpus'] == 'pqa':
+        sentences = list(itertools.islice(convert_pqa.read_sentences(config['pqa_file'], answers=1),
+                                         config['batch_size'] * config['requests']))
+    else:
+        sentences = synthetic_sentences(config['seq_length'], config['batch_size'] * config['requests'])
+    bodies = [json.dumps(sentences[i:i + config['batch_size']]).encode('utf-8')
+              for i in range(0, len(sentences), config['batch_size'])]
+
+    for body in bodies[:config['warmup']]:
+        inference.output_fn(inference.predict_fn(inference.input_fn(body, 'application/json'), model), config['accept'])
+    latencies = []
+    start_time = time.perf_counter()
+    for body in bodies:
+        request_start = time.perf_counter()
+        prediction = inference.predict_fn(inference.input_fn(body, 'application/json'), model)
+        inference.output_fn(prediction, config['accept'])
+        latencies.append(time.perf_counter() - request_start)
+    elapsed = time.perf_counter() - start_time
+    latencies.sort()
+    return {
+        'sentences_per_second': round(len(sentences) / elapsed, 1),
+        'p50_ms': round(1000 * percentile(latencies, 0.50), 2),
+        'p95_ms': round(1000 * percentile(latencies, 0.95), 2),
+        'p99_ms': round(1000 * percentile(latencies, 0.99), 2),
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+def spawn_config(config):
+    env = dict(os.environ,
+               ENCODER_BACKEND=config['backend'],
+               ENCODER_INTRA_OP_THREADS=str(config['threads']),
+               ENCODER_CACHE_SIZE='0',
+               ENCODER_METRICS='false')
+    completed = subprocess.run([sys.executable, __file__, '--run-config', json.dumps(config)],
+                               env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if completed.returncode != 0:
+        return {'error': completed.stderr.strip().splitlines()[-1] if completed.stderr.strip() else 'exit code {}'.format(completed.returncode)}
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL, universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model-dir')
+    parser.add_argument('--corpus', nargs='+', choices=['synthetic', 'pqa'], default=['synthetic'])
+    parser.add_argument('--pqa-file', default='amazon-pqa/amazon_pqa_headsets.json')
+    parser.add_argument('--batch-sizes', nargs='+', type=int, default=[1, 8, 32])
+    parser.add_argument('--seq-lengths', nargs='+', type=int, default=[16, 64, 256], help='synthetic corpus only')
+    parser.add_argument('--threads', nargs='+', type=int, default=[1, os.cpu_count()])
+    parser.add_argument('--backends', nargs='+', choices=['eager', 'torchscript', 'onnx'], default=['eager'])
+    parser.add_argument('--accept', default='application/json')
+    parser.add_argument('--requests', type=int, default=50)
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--output')
+    parser.add_argument('--run-config', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_config:
+        print(json.dumps(run_config(json.loads(args.run_config))))
+        sys.exit(0)
+    if not args.model_dir:
+        parser.error('--model-dir is required')
+
+    results = []
+    for corpus, backend, threads, batch_size in itertools.product(args.corpus, args.backends, args.threads, args.batch_sizes):
+        for seq_length in (args.seq_lengths if corpus == 'synthetic' else [None]):
+            config = {'model_dir': args.model_dir, 'corpus': corpus, 'pqa_file': args.pqa_file, 'backend': backend,
+                      'threads': threads, 'batch_size': batch_size, 'seq_length': seq_length,
+                      'accept': args.accept, 'requests': args.requests, 'warmup': args.warmup}
+            result = {key: config[key] for key in ['corpus', 'backend', 'threads', 'batch_size', 'seq_length']}
+            result.update(spawn_config(config))
+            print(json.dumps(result), file=sys.stderr)
+            results.append(result)
+
+    import torch
+    report = {
+        'commit': git_commit(),
+        'timestamp': int(time.time()),
+        'host': {'platform': platform.platform(), 'python': platform.python_version(), 'torch': torch.__version__, 'cpus': os.cpu_count()},
+        'accept': args.accept,
+        'requests': args.requests,
+        'results': results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    print(output)
@@ -0,0 +1,69 @@
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+import boto3
+from elasticsearch import Elasticsearch, RequestsHttpConnection
+
+from benchmark_stats import percentile
+
+# Per-request overhead of building the OpenSearch client inside every Lambda invocation (the previous
+# lambda_handler) against reusing the module-level client from backend/lambda/app.py. Both modes send
+# the same BM25 query; the difference in latency is the setup cost a warm invocation no longer pays.
+#
+#   python fake_bulk_endpoint.py --port 9200 --delay-ms 2
+#   python benchmark_lambda_client.py --host localhost --port 9200 --no-ssl --requests 200
+#
+# Against a real domain, leave out --no-ssl so the TLS handshake is part of the measurement.
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'backend', 'lambda'))
+
+def summarize(latencies):
+    return {'requests': len(latencies), 'mean_ms': round(statistics.mean(latencies), 3),
+            'p50_ms': round(percentile(latencies, 0.5), 3), 'p95_ms': round(percentile(latencies, 0.95), 3)}
+
+def per_invocation_client(args):
+    # What lambda_handler did before: a new session, credentials lookup and client for every event
+    session = boto3.session.Session()
+    session.get_credentials()
+    return Elasticsearch(hosts=[{'host': args.host, 'port': args.port}], http_auth=(args.user, args.password),
+                         use_ssl=not args.no_ssl, verify_certs=True, connection_class=RequestsHttpConnection)
+
+def run(get_client, args, app):
+    latencies = []
+    for i in range(args.requests):
+        start_time = time.perf_counter()
+        app.es_match_query(args.query, get_client(), args.k)
+        latencies.append((time.perf_counter() - start_time) * 1000)
+    return summarize(latencies[args.warmup:])
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', required=True, help='OpenSearch domain endpoint without scheme')
+    parser.add_argument('--port', type=int, default=443)
+    parser.add_argument('--no-ssl', action='store_true')
+    parser.add_argument('--user', default='master')
+    parser.add_argument('--password', default='Semantic123!')
+    parser.add_argument('--region', default='us-east-1')
+    parser.add_argument('--query', default='does this work with xbox?')
+    parser.add_argument('--k', type=int, default=30)
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--warmup', type=int, default=5, help='leading requests left out of the statistics')
+    args = parser.parse_args()
+
+    os.environ.update({'ES_ENDPOINT': args.host, 'ES_PORT': str(args.port), 'ES_USE_SSL': str(not args.no_ssl).lower(),
+                       'ES_USER': args.user, 'ES_PASSWORD': args.password})
+    os.environ.setdefault('AWS_REGION', args.region)
+    os.environ.setdefault('AWS_DEFAULT_REGION', args.region)
+    import app
+
+    per_invocation = run(lambda: per_invocation_client(args), args, app)
+    reused = run(app.get_es_client, args, app)
+    print(json.dumps({
+        'per_invocation_client': per_invocation,
+        'reused_client': reused,
+        'overhead_saved_p50_ms': round(per_invocation['p50_ms'] - reused['p50_ms'], 3),
+    }, indent=2))
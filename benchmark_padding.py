@@ -0,0 +1,73 @@
+import argparse
+import json
+import random
+import time
+
+from transformers import AutoTokenizer
+
+import convert_pqa
+
+# Measures how many padding tokens the encoder pushes through BERT for mixed question/answer
+# batches of the PQA corpus, with the default padding and with length bucketing.
+#
+#   python benchmark_padding.py --input amazon-pqa/amazon_pqa_headsets.json --batch-size 64 --bucket-size 16
+#
+# Pass --time to also run inference.embed_tformer both ways and compare wall-clock time.
+
+def padded_tokens(lengths, bucket_size):
+    if bucket_size <= 0 or len(lengths) <= bucket_size:
+        return max(lengths) * len(lengths)
+    lengths = sorted(lengths)
+    return sum(max(lengths[start:start + bucket_size]) * len(lengths[start:start + bucket_size])
+               for start in range(0, len(lengths), bucket_size))
+
+def padding_report(tokenizer, batches, bucket_size, max_length):
+    real = plain = bucketed = 0
+    for batch in batches:
+        lengths = [len(ids) for ids in tokenizer(batch, truncation=True, max_length=max_length)['input_ids']]
+        real += sum(lengths)
+        plain += padded_tokens(lengths, 0)
+        bucketed += padded_tokens(lengths, bucket_size)
+    return {
+        'real_tokens': real,
+        'padded_tokens': plain,
+        'bucketed_padded_tokens': bucketed,
+        'padding_waste': round(1 - real / plain, 4),
+        'bucketed_padding_waste': round(1 - real / bucketed, 4),
+        'token_reduction': round(1 - bucketed / plain, 4),
+    }
+
+def timing_report(model_dir, batches, bucket_size):
+    import inference
+    model = inference.model_fn(model_dir)
+    report = {}
+    for name, size in [('plain_seconds', 0), ('bucketed_seconds', bucket_size)]:
+        start_time = time.time()
+        for batch in batches:
+            inference.embed_tformer(model['model'], model['tokenizer'], batch, bucket_size=size)
+        report[name] = round(time.time() - start_time, 3)
+    return report
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input', default='amazon-pqa/amazon_pqa_headsets.json')
+    parser.add_argument('--rows', type=int, default=1000)
+    parser.add_argument('--model-dir', default='sentence-transformers/bert-base-nli-mean-tokens')
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--bucket-size', type=int, default=16)
+    parser.add_argument('--max-length', type=int, default=256)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--time', action='store_true')
+    args = parser.parse_args()
+
+    # Shuffle so every batch mixes short questions with long answers, as in bulk encoding
+    sentences = list(convert_pqa.read_sentences(args.input, args.rows))
+    random.Random(args.seed).shuffle(sentences)
+    batches = [sentences[i:i + args.batch_size] for i in range(0, len(sentences), args.batch_size)]
+
+    tokenizer = AutoTokenizer.from_pretrained(args.model_dir)
+    report = {'sentences': len(sentences), 'batch_size': args.batch_size, 'bucket_size': args.bucket_size}
+    report.update(padding_report(tokenizer, batches, args.bucket_size, args.max_length))
+    if args.time:
+        report.update(timing_report(args.model_dir, batches, args.bucket_size))
+    print(json.dumps(report, indent=2))
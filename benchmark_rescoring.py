@@ -0,0 +1,71 @@
+import argparse
+import json
+import os
+import sys
+import time
+
+from benchmark_stats import percentile
+
+# Recall and latency of single-stage approximate kNN against the two-stage path in backend/lambda/app.py
+# (oversampled approximate candidates rescored exactly in plain Python). Ground truth is an exact
+# brute-force knn_score script query over the full-precision vectors. Query vectors are taken from
+# documents sampled from the index.
+#
+#   python benchmark_rescoring.py --host <domain-endpoint> --k 30 --factors 2 4 8 --queries 100
+#
+# Against fake_bulk_endpoint.py --knn-noise 0.05 the single-stage ordering errors are simulated.
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'backend', 'lambda'))
+
+def sample_queries(es, index_name, vector_field, count):
+    hits = es.search(index=index_name, body={'size': count, '_source': {'includes': [vector_field]},
+                                             'query': {'match_all': {}}})['hits']['hits']
+    return [hit['_source'][vector_field] for hit in hits]
+
+def exact_ids(es, index_name, vector_field, vector, k):
+    query = {'script_score': {'query': {'match_all': {}}, 'script': {
+        'source': 'knn_score', 'lang': 'knn',
+        'params': {'field': vector_field, 'query_value': vector, 'space_type': 'cosinesimil'}}}}
+    hits = es.search(index=index_name, body={'size': k, '_source': False, 'query': query})['hits']['hits']
+    return [hit['_id'] for hit in hits]
+
+def measure(search, queries, truth, k):
+    latencies, recalls = [], []
+    for vector, expected in zip(queries, truth):
+        start_time = time.perf_counter()
+        ids = [hit['_id'] for hit in search(vector)]
+        latencies.append((time.perf_counter() - start_time) * 1000)
+        recalls.append(len(set(ids) & set(expected)) / float(len(expected) or 1))
+    return {'recall_at_k': round(sum(recalls) / len(recalls), 4),
+            'p50_ms': round(percentile(latencies, 0.5), 3), 'p95_ms': round(percentile(latencies, 0.95), 3)}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', required=True, help='OpenSearch domain endpoint without scheme')
+    parser.add_argument('--port', type=int, default=443)
+    parser.add_argument('--no-ssl', action='store_true')
+    parser.add_argument('--user', default='master')
+    parser.add_argument('--password', default='Semantic123!')
+    parser.add_argument('--region', default='us-east-1')
+    parser.add_argument('--vector-field', default='question_vector', help='full-precision vectors in _source')
+    parser.add_argument('--k', type=int, default=30)
+    parser.add_argument('--factors', type=int, nargs='+', default=[2, 4, 8], help='candidate oversampling factors')
+    parser.add_argument('--queries', type=int, default=100)
+    args = parser.parse_args()
+
+    os.environ.update({'ES_ENDPOINT': args.host, 'ES_PORT': str(args.port), 'ES_USE_SSL': str(not args.no_ssl).lower(),
+                       'ES_USER': args.user, 'ES_PASSWORD': args.password, 'RESCORE_VECTOR_FIELD': args.vector_field})
+    os.environ.setdefault('AWS_REGION', args.region)
+    os.environ.setdefault('AWS_DEFAULT_REGION', args.region)
+    import app
+
+    es = app.get_es_client()
+    queries = sample_queries(es, 'nlp_pqa', args.vector_field, args.queries)
+    truth = [exact_ids(es, 'nlp_pqa', args.vector_field, vector, args.k) for vector in queries]
+
+    report = {'queries': len(queries), 'k': args.k,
+              'single_stage': measure(lambda vector: app.knn_candidates(vector, es, args.k), queries, truth, args.k)}
+    for factor in args.factors:
+        report['two_stage_x{}'.format(factor)] = measure(
+            lambda vector: app.two_stage_hits(vector, es, args.k, factor=factor), queries, truth, args.k)
+    print(json.dumps(report, indent=2))
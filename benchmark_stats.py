@@ -0,0 +1,5 @@
+# Shared by the benchmark scripts: nearest-rank percentile of a list of latencies, q in [0, 1].
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
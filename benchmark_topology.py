@@ -0,0 +1,81 @@
+import argparse
+import json
+import multiprocessing
+import os
+import time
+
+# Model loading in the parent must not start torch's thread pools before the workers are forked
+os.environ['ENCODER_WARMUP_BATCH_SIZE'] = '0'
+
+import inference
+from benchmark_stats import percentile
+
+# Finds the best split of CPU cores into encoder worker processes x intra-op threads per worker.
+# The model is loaded once and its weights are moved to shared memory before forking, so all
+# workers read the same copy. Every worker is pinned to its own slice of cores.
+#
+#   python benchmark_topology.py --model-dir transformer --cores 8 --batch-size 1 --requests 400
+#
+# Use the winning split as SAGEMAKER_MODEL_SERVER_WORKERS and ENCODER_INTRA_OP_THREADS.
+
+SENTENCES = ['Does this work with xbox?', 'Is the microphone noise cancelling?',
+             'Can I use this headset with my phone and my laptop at the same time?',
+             'How long does the battery last when it is used for gaming every day?']
+
+def topologies(cores):
+    return [(workers, cores // workers) for workers in range(1, cores + 1) if cores % workers == 0]
+
+def take_request(remaining):
+    with remaining.get_lock():
+        if remaining.value == 0:
+            return False
+        remaining.value -= 1
+        return True
+
+def run_worker(model, cpus, threads, batch_size, remaining, results):
+    inference.configure_threads(threads, 1, cpus)
+    batch = [SENTENCES[i % len(SENTENCES)] for i in range(batch_size)]
+    inference.embed_tformer(model['model'], model['tokenizer'], batch)
+    latencies = []
+    while take_request(remaining):
+        start_time = time.time()
+        inference.embed_tformer(model['model'], model['tokenizer'], batch)
+        latencies.append(time.time() - start_time)
+    results.put(latencies)
+
+def benchmark(model, cpus, workers, threads, batch_size, number_requests):
+    context = multiprocessing.get_context('fork')
+    remaining, results = context.Value('i', number_requests), context.Queue()
+    processes = [context.Process(target=run_worker, args=(model, cpus[w * threads:(w + 1) * threads], threads, batch_size, remaining, results))
+                 for w in range(workers)]
+    start_time = time.time()
+    for process in processes:
+        process.start()
+    latencies = sorted(latency for _ in processes for latency in results.get())
+    elapsed = time.time() - start_time
+    for process in processes:
+        process.join()
+    return {
+        'workers': workers,
+        'threads_per_worker': threads,
+        'sentences_per_second': round(len(latencies) * batch_size / elapsed, 1),
+        'p50_ms': round(1000 * percentile(latencies, 0.50), 2),
+        'p99_ms': round(1000 * percentile(latencies, 0.99), 2),
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model-dir', required=True)
+    parser.add_argument('--cores', type=int, default=inference.available_cpus())
+    parser.add_argument('--batch-size', type=int, default=1)
+    parser.add_argument('--requests', type=int, default=400)
+    args = parser.parse_args()
+
+    model = inference.model_fn(args.model_dir)
+    if hasattr(model['model'], 'share_memory'):
+        model['model'].share_memory()
+    cpus = sorted(os.sched_getaffinity(0))[:args.cores]
+
+    runs = [benchmark(model, cpus, workers, threads, args.batch_size, args.requests) for workers, threads in topologies(args.cores)]
+    best = max(runs, key=lambda run: run['sentences_per_second'])
+    print(json.dumps({'cores': args.cores, 'batch_size': args.batch_size, 'runs': runs, 'best': best}, indent=2))
@@ -0,0 +1,55 @@
+import argparse
+import json
+import sys
+
+import torch
+
+import convert_pqa
+import inference
+
+# Equivalence check of the memory-lean inference path against the original expanded-mask pooling
+# under no_grad, plus the tolerance of bf16 CPU autocast against fp32. Exits non-zero on failure.
+#
+#   python check_pooling.py --model-dir transformer --input amazon-pqa/amazon_pqa_headsets.json
+
+def reference_mean_pooling(model_output, attention_mask):
+    token_embeddings = model_output[0]
+    input_mask_expanded = attention_mask.unsqueeze(-1).expand(token_embeddings.size()).float()
+    sum_embeddings = torch.sum(token_embeddings * input_mask_expanded, 1)
+    sum_mask = torch.clamp(input_mask_expanded.sum(1), min=1e-9)
+    return sum_embeddings / sum_mask
+
+def reference_embed(model, tokenizer, sentences):
+    encoded_input = tokenizer(sentences, padding=True, truncation=True, max_length=inference.MAX_LENGTH, return_tensors='pt')
+    with torch.no_grad():
+        model_output = model(**encoded_input)
+    return reference_mean_pooling(model_output, encoded_input['attention_mask'])
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model-dir', required=True)
+    parser.add_argument('--input', default='amazon-pqa/amazon_pqa_headsets.json')
+    parser.add_argument('--rows', type=int, default=64)
+    parser.add_argument('--atol', type=float, default=1e-5)
+    parser.add_argument('--bf16-min-cosine', type=float, default=0.99)
+    args = parser.parse_args()
+
+    model = inference.model_fn(args.model_dir)
+    nlp_model, tokenizer = model['model'], model['tokenizer']
+    sentences = list(convert_pqa.read_sentences(args.input, args.rows, answers=1))
+
+    inference.AUTOCAST = 'none'
+    reference = reference_embed(nlp_model, tokenizer, sentences)
+    lean = inference.embed_tformer(nlp_model, tokenizer, sentences, bucket_size=0)
+    inference.AUTOCAST = 'bf16'
+    bf16 = inference.embed_tformer(nlp_model, tokenizer, sentences, bucket_size=0)
+
+    max_abs_diff = (reference - lean).abs().max().item()
+    bf16_cosine = torch.nn.functional.cosine_similarity(reference, bf16, dim=1).min().item()
+    report = {
+        'sentences': len(sentences),
+        'lean': {'bit_identical': torch.equal(reference, lean), 'max_abs_diff': max_abs_diff, 'passed': max_abs_diff <= args.atol},
+        'bf16_autocast': {'min_cosine': round(bf16_cosine, 6), 'passed': bf16_cosine >= args.bf16_min_cosine},
+    }
+    print(json.dumps(report, indent=2))
+    sys.exit(0 if report['lean']['passed'] and report['bf16_autocast']['passed'] else 1)
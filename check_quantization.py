@@ -0,0 +1,82 @@
+import argparse
+import copy
+import io
+import itertools
+import json
+import resource
+import time
+
+import torch
+
+import convert_pqa
+import inference
+
+# Compares the dynamically quantized INT8 encoder against the fp32 encoder on a held-out PQA sample:
+# cosine agreement of the embeddings, overlap of the top-k question neighbours, latency and memory.
+#
+#   python check_quantization.py --input amazon-pqa/amazon_pqa_headsets.json --skip 1000 --rows 500
+
+def model_size_mb(nlp_model):
+    buffer = io.BytesIO()
+    torch.save(nlp_model.state_dict(), buffer)
+    return round(buffer.tell() / 1024 / 1024, 1)
+
+def peak_rss_mb():
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+def embed_all(nlp_model, tokenizer, sentences, batch_size):
+    embeddings = []
+    latencies = []
+    for i in range(0, len(sentences), batch_size):
+        start_time = time.time()
+        embeddings.append(inference.embed_tformer(nlp_model, tokenizer, sentences[i:i + batch_size]))
+        latencies.append(time.time() - start_time)
+    latencies.sort()
+    return torch.cat(embeddings), {
+        'total_seconds': round(sum(latencies), 3),
+        'p50_batch_ms': round(1000 * latencies[len(latencies) // 2], 2),
+        'sentences_per_second': round(len(sentences) / sum(latencies), 1),
+    }
+
+def top_k(embeddings, k):
+    normalized = torch.nn.functional.normalize(embeddings, dim=1)
+    similarities = normalized @ normalized.T
+    similarities.fill_diagonal_(-float('inf'))
+    return similarities.topk(k, dim=1).indices
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input', default='amazon-pqa/amazon_pqa_headsets.json')
+    parser.add_argument('--model-dir', default='sentence-transformers/bert-base-nli-mean-tokens')
+    parser.add_argument('--skip', type=int, default=1000, help='rows used for indexing elsewhere, kept out of the sample')
+    parser.add_argument('--rows', type=int, default=500)
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--k', type=int, default=10)
+    args = parser.parse_args()
+
+    questions = [record['question_text'] for record in
+                 itertools.islice(convert_pqa.read_records(args.input), args.skip, args.skip + args.rows)]
+    model = inference.model_fn(args.model_dir)
+    fp32_model, tokenizer = model['model'].to('cpu'), model['tokenizer']
+    int8_model = inference.quantize_model(copy.deepcopy(fp32_model))
+
+    fp32_embeddings, fp32_latency = embed_all(fp32_model, tokenizer, questions, args.batch_size)
+    int8_embeddings, int8_latency = embed_all(int8_model, tokenizer, questions, args.batch_size)
+
+    cosine = torch.nn.functional.cosine_similarity(fp32_embeddings, int8_embeddings, dim=1)
+    fp32_neighbors, int8_neighbors = top_k(fp32_embeddings, args.k), top_k(int8_embeddings, args.k)
+    overlap = [len(set(a.tolist()) & set(b.tolist())) / args.k for a, b in zip(fp32_neighbors, int8_neighbors)]
+
+    print(json.dumps({
+        'sentences': len(questions),
+        'cosine_agreement': {
+            'mean': round(cosine.mean().item(), 5),
+            'p5': round(cosine.quantile(0.05).item(), 5),
+            'min': round(cosine.min().item(), 5),
+        },
+        'top_k_overlap': {'k': args.k, 'mean': round(sum(overlap) / len(overlap), 4), 'min': min(overlap)},
+        'fp32': dict(fp32_latency, model_size_mb=model_size_mb(fp32_model)),
+        'int8': dict(int8_latency, model_size_mb=model_size_mb(int8_model)),
+        # Both models live in this process, so this is their combined high-water mark
+        'peak_rss_mb': peak_rss_mb(),
+    }, indent=2))
@@ -1,20 +1,141 @@
+import argparse
+import gzip
 import json
+import os
+from concurrent.futures import ProcessPoolExecutor
 
-with open("amazon-pqa/amazon_pqa_headsets.json") as input:
-  with open("amazon-pqa/converted_amazon_pqa_headsets_1000.json","w") as output:
-    i=0
-    for line in input:
-      line_data = json.loads(line)
-      meta = '{"index":{"_index":"nlp_pqa"}}\n'
-      output.write(meta)
-      data = '{"question":"' 
-      data = data + line_data['question_text']
-      data = data + '","answer":"'
-      data = data + line_data['answers'][0]['answer_text']
-      data = data + '"}\n'
-      output.write(data)
-      i+=1
-      if(i == 1000):
-        break
-      
-print("converted file is saved to 'amazon-pqa/converted_amazon_pqa_headsets_1000.json'")
\ No newline at end of file
+# Converts Amazon PQA files (one JSON record per line, optionally gzipped) into NDJSON files for the
+# OpenSearch _bulk API. Records are streamed and serialized with json.dumps, so quotes and newlines in
+# answers are escaped correctly. Output files are split by size and document count, and input files
+# are converted in parallel, one process per file.
+#
+#   python convert_pqa.py amazon-pqa/amazon_pqa_*.json.gz --output-dir amazon-pqa/bulk --workers 8
+
+INDEX_NAME = 'nlp_pqa'
+MAX_BULK_BYTES = 10 * 1024 * 1024
+MAX_BULK_DOCS = 5000
+
+
+def open_input(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8')
+    return open(path, encoding='utf-8')
+
+
+def read_records(path, limit=None):
+    with open_input(path) as input:
+        for i, line in enumerate(input):
+            if limit is not None and i == limit:
+                break
+            if line.strip():
+                yield json.loads(line)
+
+
+def read_sentences(path, limit=None, answers=None):
+    # Questions each followed by their answers (all of them, or the first `answers`), as the encoder
+    # benchmarks and checks sample them
+    for record in read_records(path, limit):
+        yield record['question_text']
+        for answer in record.get('answers', [])[:answers]:
+            yield answer['answer_text']
+
+
+def to_document(record):
+    if not record.get('answers'):
+        return None
+    document = {'question': record['question_text'], 'answer': record['answers'][0]['answer_text']}
+    if record.get('question_id'):
+        document['question_id'] = record['question_id']
+    if len(record['answers']) > 1:
+        # Every answer is kept, including those merged in from near-duplicate questions by dedup_pqa.py
+        document['answers'] = [answer['answer_text'] for answer in record['answers']]
+    return document
+
+
+def bulk_action(record, index_name):
+    meta = {'_index': index_name}
+    if record.get('question_id'):
+        # Stable ids make re-running a conversion or an ingestion idempotent
+        meta['_id'] = record['question_id']
+    return {'index': meta}
+
+
+def bulk_entry(action, document):
+    return (json.dumps(action) + '\n' + json.dumps(document) + '\n').encode('utf-8')
+
+
+class BulkFileWriter(object):
+    def __init__(self, output_dir, prefix, max_bytes=MAX_BULK_BYTES, max_docs=MAX_BULK_DOCS):
+        self.output_dir = output_dir
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.max_docs = max_docs
+        self.paths = []
+        self.output = None
+        self.size = 0
+        self.docs = 0
+
+    def write(self, entry):
+        if self.output is None or self.docs >= self.max_docs or (self.docs and self.size + len(entry) > self.max_bytes):
+            self.roll()
+        self.output.write(entry)
+        self.size += len(entry)
+        self.docs += 1
+
+    def roll(self):
+        self.close()
+        path = os.path.join(self.output_dir, '{}_{:05d}.ndjson'.format(self.prefix, len(self.paths)))
+        self.paths.append(path)
+        self.output = open(path, 'wb')
+        self.size = 0
+        self.docs = 0
+
+    def close(self):
+        if self.output is not None:
+            self.output.close()
+            self.output = None
+
+
+def input_prefix(path):
+    name = os.path.basename(path)
+    for suffix in ['.gz', '.json', '.jsonl']:
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+    return name
+
+
+def convert_file(path, output_dir, index_name=INDEX_NAME, max_bytes=MAX_BULK_BYTES, max_docs=MAX_BULK_DOCS, limit=None):
+    writer = BulkFileWriter(output_dir, 'converted_' + input_prefix(path), max_bytes, max_docs)
+    converted = skipped = 0
+    try:
+        for record in read_records(path, limit):
+            document = to_document(record)
+            if document is None:
+                skipped += 1
+                continue
+            writer.write(bulk_entry(bulk_action(record, index_name), document))
+            converted += 1
+    finally:
+        writer.close()
+    return {'input': path, 'documents': converted, 'skipped': skipped, 'files': writer.paths}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('inputs', nargs='*', default=['amazon-pqa/amazon_pqa_headsets.json'])
+    parser.add_argument('--output-dir', default='amazon-pqa')
+    parser.add_argument('--index', default=INDEX_NAME)
+    parser.add_argument('--max-bytes', type=int, default=MAX_BULK_BYTES, help='upper bound for one _bulk file')
+    parser.add_argument('--max-docs', type=int, default=MAX_BULK_DOCS, help='documents per _bulk file')
+    parser.add_argument('--limit', type=int, help='records read from each input file')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    with ProcessPoolExecutor(max_workers=min(args.workers, len(args.inputs))) as executor:
+        futures = [executor.submit(convert_file, path, args.output_dir, args.index, args.max_bytes, args.max_docs, args.limit)
+                   for path in args.inputs]
+        for future in futures:
+            result = future.result()
+            print("converted {} documents from '{}' into {} file(s) in '{}' ({} without answers skipped)".format(
+                result['documents'], result['input'], len(result['files']), args.output_dir, result['skipped']))
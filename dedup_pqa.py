@@ -0,0 +1,135 @@
+import argparse
+import gzip
+import json
+import re
+import zlib
+
+import numpy as np
+
+import convert_pqa
+
+# Collapses near-duplicate PQA questions before indexing. Questions are compared with MinHash over
+# character shingles and banded LSH; a candidate whose estimated Jaccard similarity reaches --threshold
+# (and, with --model-dir, whose embedding cosine reaches --min-cosine) is folded into the first question
+# seen, which keeps the answers of all its duplicates. The output is PQA JSON lines that convert_pqa.py
+# and ingest_pqa.py read like the original files.
+#
+#   python dedup_pqa.py amazon-pqa/amazon_pqa_headsets.json --output amazon-pqa/amazon_pqa_headsets_dedup.json.gz
+
+PRIME = (1 << 31) - 1
+NUM_PERM = 64
+BANDS = 16
+
+
+def shingles(text, size=4):
+    text = re.sub(r'[^a-z0-9 ]', '', ' '.join(text.lower().split()))
+    if len(text) <= size:
+        return {text}
+    return {text[i:i + size] for i in range(len(text) - size + 1)}
+
+
+class MinHashLSH(object):
+    def __init__(self, num_perm=NUM_PERM, bands=BANDS, threshold=0.8, seed=1):
+        rng = np.random.RandomState(seed)
+        self.a = rng.randint(1, PRIME, size=(num_perm, 1)).astype(np.uint64)
+        self.b = rng.randint(0, PRIME, size=(num_perm, 1)).astype(np.uint64)
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.threshold = threshold
+        self.buckets = {}
+        self.signatures = {}
+
+    def signature(self, text):
+        hashes = np.array([zlib.crc32(shingle.encode('utf-8')) & PRIME for shingle in shingles(text)], dtype=np.uint64)
+        return ((self.a * hashes + self.b) % PRIME).min(axis=1).astype(np.uint32)
+
+    def band_keys(self, signature):
+        return [(band, signature[band * self.rows:(band + 1) * self.rows].tobytes()) for band in range(self.bands)]
+
+    # Candidates sharing at least one band, best estimated Jaccard similarity first
+    def query(self, signature):
+        candidates = set()
+        for key in self.band_keys(signature):
+            candidates.update(self.buckets.get(key, ()))
+        scored = [(float(np.mean(self.signatures[c] == signature)), c) for c in candidates]
+        return [c for score, c in sorted(scored, reverse=True) if score >= self.threshold]
+
+    def insert(self, key, signature):
+        self.signatures[key] = signature
+        for band_key in self.band_keys(signature):
+            self.buckets.setdefault(band_key, []).append(key)
+
+
+def find_duplicates(paths, lsh, model=None, min_cosine=0.9, batch_size=256):
+    duplicate_of = {}
+    extra_answers = {}
+    vectors = {}
+    records = ((path, i, record) for path in paths for i, record in enumerate(convert_pqa.read_records(path)))
+    while True:
+        batch = [item for item in (next(records, None) for _ in range(batch_size)) if item is not None]
+        if not batch:
+            break
+        batch_vectors = None
+        if model is not None:
+            import inference
+            batch_vectors = inference.l2_normalize(inference.encode_sentences([r['question_text'] for _, _, r in batch], model))
+        for j, (path, i, record) in enumerate(batch):
+            key = (path, i)
+            signature = lsh.signature(record['question_text'])
+            canonical = None
+            for candidate in lsh.query(signature):
+                if batch_vectors is None or float(vectors[candidate] @ batch_vectors[j]) >= min_cosine:
+                    canonical = candidate
+                    break
+            if canonical is None:
+                lsh.insert(key, signature)
+                if batch_vectors is not None:
+                    vectors[key] = batch_vectors[j]
+            else:
+                duplicate_of[key] = canonical
+                extra_answers.setdefault(canonical, []).extend(record.get('answers', []))
+    return duplicate_of, extra_answers
+
+
+def write_deduplicated(paths, output_path, duplicate_of, extra_answers):
+    opener = gzip.open if output_path.endswith('.gz') else open
+    written = 0
+    with opener(output_path, 'wt', encoding='utf-8') as output:
+        for path in paths:
+            for i, record in enumerate(convert_pqa.read_records(path)):
+                key = (path, i)
+                if key in duplicate_of:
+                    continue
+                if key in extra_answers:
+                    record['answers'] = record.get('answers', []) + extra_answers[key]
+                output.write(json.dumps(record) + '\n')
+                written += 1
+    return written
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('inputs', nargs='+')
+    parser.add_argument('--output', required=True)
+    parser.add_argument('--threshold', type=float, default=0.8, help='minimum estimated Jaccard similarity')
+    parser.add_argument('--model-dir', help='also require embedding cosine similarity of at least --min-cosine')
+    parser.add_argument('--min-cosine', type=float, default=0.9)
+    parser.add_argument('--dimension', type=int, default=768, help='knn_vector dimension used to estimate the saving')
+    args = parser.parse_args()
+
+    model = None
+    if args.model_dir:
+        import inference
+        model = inference.model_fn(args.model_dir)
+    duplicate_of, extra_answers = find_duplicates(args.inputs, MinHashLSH(threshold=args.threshold), model, args.min_cosine)
+    written = write_deduplicated(args.inputs, args.output, duplicate_of, extra_answers)
+    records = written + len(duplicate_of)
+    print(json.dumps({
+        'records': records,
+        'unique_questions': written,
+        'duplicates_removed': len(duplicate_of),
+        'reduction': round(len(duplicate_of) / records, 4) if records else 0,
+        # Each removed document would have cost one float32 vector and one kNN graph node
+        'vector_bytes_saved': len(duplicate_of) * args.dimension * 4,
+        'output': args.output,
+    }, indent=2))
@@ -0,0 +1,76 @@
+import argparse
+import inspect
+import os
+
+import torch
+from transformers import AutoTokenizer, AutoModel
+
+import inference
+
+# One-shot export of the sentence encoder into an optimized graph next to the Hugging Face weights,
+# so the endpoint can serve it with ENCODER_BACKEND=torchscript or ENCODER_BACKEND=onnx.
+#
+#   python export_encoder.py --model-dir transformer --format torchscript
+#   python export_encoder.py --model-dir transformer --format onnx
+#
+# --format safetensors rewrites the weights as model.safetensors, which ENCODER_OFFLINE=true memory-maps.
+
+SAMPLE_SENTENCES = ['Does this work with xbox?', 'Can I use this headset with my phone and my laptop at the same time?']
+
+# Exported graphs take the tokenizer outputs positionally and return a plain tuple
+class TokenEmbeddings(torch.nn.Module):
+    def __init__(self, nlp_model, input_names):
+        super().__init__()
+        self.nlp_model = nlp_model
+        self.input_names = input_names
+
+    def forward(self, *inputs):
+        return (self.nlp_model(**dict(zip(self.input_names, inputs)))[0],)
+
+def sample_inputs(tokenizer):
+    encoded_input = tokenizer(SAMPLE_SENTENCES, padding=True, truncation=True, max_length=inference.MAX_LENGTH, return_tensors='pt')
+    return tuple(encoded_input[name] for name in tokenizer.model_input_names)
+
+def export_torchscript(nlp_model, tokenizer, model_dir):
+    with torch.no_grad():
+        traced = torch.jit.trace(nlp_model, sample_inputs(tokenizer), strict=False)
+    traced = torch.jit.freeze(traced)
+    output_path = os.path.join(model_dir, inference.TORCHSCRIPT_FILE)
+    traced.save(output_path)
+    return output_path
+
+def export_onnx(nlp_model, tokenizer, model_dir, opset):
+    input_names = list(tokenizer.model_input_names)
+    dynamic_axes = {name: {0: 'batch', 1: 'sequence'} for name in input_names + ['last_hidden_state']}
+    output_path = os.path.join(model_dir, inference.ONNX_FILE)
+    options = {}
+    # Newer torch releases default to the dynamo exporter, which does not take dynamic_axes
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+        options['dynamo'] = False
+    with torch.no_grad():
+        torch.onnx.export(nlp_model, sample_inputs(tokenizer), output_path,
+                          input_names=input_names, output_names=['last_hidden_state'],
+                          dynamic_axes=dynamic_axes, opset_version=opset, do_constant_folding=True, **options)
+    return output_path
+
+def export_safetensors(model_dir):
+    AutoModel.from_pretrained(model_dir).save_pretrained(model_dir, safe_serialization=True)
+    return os.path.join(model_dir, inference.SAFETENSORS_FILE)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model-dir', required=True, help='directory holding the saved tokenizer and model')
+    parser.add_argument('--format', choices=['torchscript', 'onnx', 'safetensors'], required=True)
+    parser.add_argument('--opset', type=int, default=14)
+    args = parser.parse_args()
+
+    if args.format == 'safetensors':
+        output_path = export_safetensors(args.model_dir)
+    else:
+        tokenizer = AutoTokenizer.from_pretrained(args.model_dir)
+        nlp_model = TokenEmbeddings(AutoModel.from_pretrained(args.model_dir), list(tokenizer.model_input_names)).eval()
+        if args.format == 'torchscript':
+            output_path = export_torchscript(nlp_model, tokenizer, args.model_dir)
+        else:
+            output_path = export_onnx(nlp_model, tokenizer, args.model_dir, args.opset)
+    print("exported {} encoder to '{}'".format(args.format, output_path))
@@ -0,0 +1,186 @@
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Minimal stand-in for an OpenSearch domain that accepts index creation, _bulk, _search and _msearch requests, for
+# running ingest_pqa.py and benchmark_lambda_client.py locally. It validates the NDJSON body, keeps documents by _id in memory and
+# can add latency or throttle a fraction of requests with 429 to exercise retries and backpressure.
+#
+#   python fake_bulk_endpoint.py --port 9200 --delay-ms 50 --throttle-rate 0.1
+#   python ingest_pqa.py amazon-pqa/amazon_pqa_headsets.json --model-dir transformer --endpoint http://localhost:9200
+
+
+class FakeBulkHandler(BaseHTTPRequestHandler):
+    documents = {}
+    meta = {}
+    index_uuid = uuid.uuid4().hex
+    created = False
+    lock = threading.Lock()
+    delay = 0.0
+    throttle_rate = 0.0
+    knn_noise = 0.0
+
+    def reply(self, status, body):
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        # Lets newer elasticsearch-py 7.x clients pass their product check
+        self.send_header('X-Elastic-Product', 'Elasticsearch')
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_PUT(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        index_name = self.path.strip('/').split('/')[0]
+        if self.path.rstrip('/').endswith('/_mapping'):
+            with self.lock:
+                self.meta.update(json.loads(body).get('_meta', {}))
+            return self.reply(200, {'acknowledged': True})
+        with self.lock:
+            if FakeBulkHandler.created:
+                return self.reply(400, {'error': {'type': 'resource_already_exists_exception'}})
+            FakeBulkHandler.created = True
+        self.reply(200, {'acknowledged': True, 'index': index_name})
+
+    # Deleting the index drops its documents and _meta; the next one gets a new uuid
+    def do_DELETE(self):
+        with self.lock:
+            FakeBulkHandler.index_uuid = uuid.uuid4().hex
+            FakeBulkHandler.created = False
+            self.documents.clear()
+            self.meta.clear()
+        self.reply(200, {'acknowledged': True})
+
+    def do_GET(self):
+        if self.path == '/':
+            return self.reply(200, {'version': {'number': '7.10.2', 'build_flavor': 'default'}, 'tagline': 'You Know, for Search'})
+        if self.path.split('?')[0].endswith('/_mapping'):
+            index_name = self.path.strip('/').split('/')[0]
+            with self.lock:
+                return self.reply(200, {index_name: {'mappings': {'_meta': dict(self.meta)}}})
+        if self.path.split('?')[0].strip('/') and '/' not in self.path.split('?')[0].strip('/'):
+            index_name = self.path.split('?')[0].strip('/')
+            with self.lock:
+                return self.reply(200, {index_name: {'mappings': {'_meta': dict(self.meta)},
+                                                     'settings': {'index': {'uuid': self.index_uuid}}}})
+        if self.path.split('?')[0].endswith('/_count'):
+            with self.lock:
+                return self.reply(200, {'count': len(self.documents)})
+        self.reply(404, {'error': 'not found'})
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8')
+        if self.path.split('?')[0].endswith('/_msearch'):
+            return self.msearch(body)
+        if self.path.split('?')[0].endswith('/_search'):
+            return self.search(json.loads(body) if body else {})
+        if not self.path.split('?')[0].endswith('/_bulk'):
+            return self.reply(404, {'error': 'not found'})
+        time.sleep(self.delay)
+        if random.random() < self.throttle_rate:
+            return self.reply(429, {'error': 'too many requests'})
+        lines = body.splitlines()
+        if len(lines) % 2:
+            return self.reply(400, {'error': 'bulk body must hold action and source line pairs'})
+        items = []
+        with self.lock:
+            for action_line, source_line in zip(lines[0::2], lines[1::2]):
+                meta = json.loads(action_line)['index']
+                doc_id = meta.get('_id') or str(len(self.documents))
+                self.documents[doc_id] = json.loads(source_line)
+                items.append({'index': {'_index': meta.get('_index'), '_id': doc_id, 'status': 201}})
+        self.reply(200, {'took': int(self.delay * 1000), 'errors': False, 'items': items})
+
+    # Scores match queries by the number of query terms in the question and knn queries by cosine
+    # similarity to question_vector; any other query returns documents in insertion order
+    def score(self, query, document):
+        if 'match' in query:
+            terms = set(query['match']['question']['query'].lower().split())
+            return float(len(terms & set(document.get('question', '').lower().split())))
+        if 'knn' in query:
+            # Noise stands in for the ordering errors of an approximate graph over compressed vectors
+            score = self.cosine(query['knn']['question_vector']['vector'], document.get('question_vector'))
+            return score + random.gauss(0, self.knn_noise) if self.knn_noise else score
+        if 'script_score' in query:
+            # Exact brute-force scoring, as the k-NN plugin's knn_score script does
+            params = query['script_score']['script']['params']
+            return 1.0 + self.cosine(params['query_value'], document.get(params['field']))
+        return 1.0
+
+    @staticmethod
+    def cosine(vector, stored):
+        stored = stored or []
+        norm = (sum(x * x for x in vector) * sum(x * x for x in stored)) ** 0.5
+        return sum(x * y for x, y in zip(vector, stored)) / norm if norm else 0.0
+
+    def hit(self, doc_id, document, score, body):
+        query = body.get('query', {})
+        hit = {'_id': doc_id, '_score': score, 'sort': [score, document.get('question_id')],
+               'fields': {k: [v] for k, v in document.items() if k in ('question', 'answer')}}
+        source = body.get('_source', True)
+        if isinstance(source, dict) and 'includes' in source:
+            hit['_source'] = {k: v for k, v in document.items() if k in source['includes']}
+        elif source is not False:
+            hit['_source'] = {k: v for k, v in document.items() if k != 'question_vector'}
+        if 'match' in query:
+            terms = set(query['match']['question']['query'].lower().split())
+            hit['highlight'] = {'question': [' '.join('<em>{}</em>'.format(w) if w.lower() in terms else w
+                                                      for w in document.get('question', '').split())]}
+        return hit
+
+    # Sorted by score, then question_id (missing last), which also makes search_after cursors work
+    @staticmethod
+    def sort_key(score, question_id):
+        return (-score, question_id is None, question_id or '')
+
+    def run_search(self, body):
+        query = body.get('query', {})
+        with self.lock:
+            scored = [(self.score(query, document), doc_id, document) for doc_id, document in self.documents.items()]
+        if 'match' in query:
+            scored = [item for item in scored if item[0] > 0]
+        scored.sort(key=lambda item: self.sort_key(item[0], item[2].get('question_id')))
+        if body.get('search_after'):
+            after = self.sort_key(*body['search_after'])
+            scored = [item for item in scored if self.sort_key(item[0], item[2].get('question_id')) > after]
+        hits = [self.hit(doc_id, document, score, body) for score, doc_id, document in scored[:body.get('size', 10)]]
+        result = {'took': int(self.delay * 1000), 'hits': {'hits': hits}}
+        if body.get('track_total_hits', True) is not False:
+            result['hits']['total'] = {'value': len(scored), 'relation': 'eq'}
+        return result
+
+    def search(self, body):
+        time.sleep(self.delay)
+        self.reply(200, self.run_search(body))
+
+    def msearch(self, body):
+        time.sleep(self.delay)
+        lines = [json.loads(line) for line in body.splitlines() if line.strip()]
+        self.reply(200, {'responses': [dict(self.run_search(search), status=200) for search in lines[1::2]]})
+
+    def log_message(self, format, *args):
+        pass
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=9200)
+    parser.add_argument('--delay-ms', type=float, default=0)
+    parser.add_argument('--throttle-rate', type=float, default=0)
+    parser.add_argument('--knn-noise', type=float, default=0, help='standard deviation added to knn scores')
+    args = parser.parse_args()
+
+    FakeBulkHandler.delay = args.delay_ms / 1000.0
+    FakeBulkHandler.throttle_rate = args.throttle_rate
+    FakeBulkHandler.knn_noise = args.knn_noise
+    server = ThreadingHTTPServer(('localhost', args.port), FakeBulkHandler)
+    print('fake bulk endpoint listening on http://localhost:{}'.format(args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print('{} documents indexed'.format(len(FakeBulkHandler.documents)))
@@ -0,0 +1,74 @@
+import argparse
+import json
+import os
+
+import numpy as np
+
+# The encoder must produce full-width vectors while the projection is being fitted
+os.environ['ENCODER_PROJECTION'] = 'false'
+os.environ['ENCODER_NORMALIZE'] = 'false'
+
+import convert_pqa
+import inference
+
+# Fits a PCA projection of the encoder embeddings on a PQA sample and saves it next to the model as
+# projection.npz, for serving with ENCODER_PROJECTION=true. Recall@k of the reduced vectors against
+# full dimensionality is reported for every candidate dimension, using held-out questions as queries.
+#
+#   python fit_projection.py --model-dir transformer --dims 384 192 96 --save-dim 192
+#
+# The knn_vector "dimension" of the nlp_pqa index mapping has to match the saved dimension.
+
+def encode(model, sentences, batch_size):
+    return np.concatenate([inference.encode_sentences(sentences[i:i + batch_size], model)
+                           for i in range(0, len(sentences), batch_size)])
+
+def fit_pca(embeddings):
+    mean = embeddings.mean(axis=0)
+    _, singular_values, components = np.linalg.svd(embeddings - mean, full_matrices=False)
+    explained = singular_values ** 2 / np.sum(singular_values ** 2)
+    return mean, components, explained
+
+def top_k(queries, documents, k):
+    queries = inference.l2_normalize(queries)
+    documents = inference.l2_normalize(documents)
+    return np.argsort(-(queries @ documents.T), axis=1)[:, :k]
+
+def recall_at_k(full_neighbors, reduced_neighbors):
+    k = full_neighbors.shape[1]
+    return float(np.mean([len(set(a) & set(b)) / k for a, b in zip(full_neighbors, reduced_neighbors)]))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model-dir', required=True)
+    parser.add_argument('--input', default='amazon-pqa/amazon_pqa_headsets.json')
+    parser.add_argument('--rows', type=int, default=2000)
+    parser.add_argument('--queries', type=int, default=200, help='held-out sentences used as queries, not used for fitting')
+    parser.add_argument('--dims', nargs='+', type=int, default=[384, 192, 96])
+    parser.add_argument('--save-dim', type=int, help='dimension written to projection.npz')
+    parser.add_argument('--k', type=int, default=30)
+    parser.add_argument('--batch-size', type=int, default=32)
+    args = parser.parse_args()
+
+    model = inference.model_fn(args.model_dir)
+    sentences = list(convert_pqa.read_sentences(args.input, args.rows))
+    embeddings = encode(model, sentences, args.batch_size)
+    queries, documents = embeddings[:args.queries], embeddings[args.queries:]
+
+    mean, components, explained = fit_pca(documents)
+    full_neighbors = top_k(queries, documents, args.k)
+    report = {'sentences': len(sentences), 'full_dim': embeddings.shape[1], 'k': args.k, 'dims': []}
+    for dim in args.dims:
+        projection = inference.Projection(mean, components[:dim])
+        reduced_neighbors = top_k(projection(queries), projection(documents), args.k)
+        report['dims'].append({
+            'dim': dim,
+            'explained_variance': round(float(explained[:dim].sum()), 4),
+            'recall_at_k': round(recall_at_k(full_neighbors, reduced_neighbors), 4),
+        })
+
+    if args.save_dim:
+        output_path = os.path.join(args.model_dir, inference.PROJECTION_FILE)
+        np.savez(output_path, mean=mean.astype(np.float32), components=components[:args.save_dim].astype(np.float32))
+        report['saved'] = output_path
+    print(json.dumps(report, indent=2))
@@ -112,7 +112,7 @@ class App extends React.Component {
         .then(response => {
           // this.setState({results: []});
           this.setState({
-            results: response.map(function (elem) {
+            results: response.results.map(function (elem) {
               let result = {};
               result.question = elem.question;
               result.answer = elem.answer;
@@ -9,7 +9,7 @@ pip install -I openai -t dist
 
 # remove extraneous bits from installed packages
 rm -r dist/*.dist-info
-cp config.py chain_queryEncoder.py main_queryEncoder.py chain_documentEncoder.py main_documentEncoder.py dist/
+cp config.py embedding_codec.py secrets_cache.py chain_queryEncoder.py main_queryEncoder.py chain_documentEncoder.py main_documentEncoder.py dist/
 cd dist && zip -r ../queryEncoder.zip *
 zip -r ../documentEncoder.zip * -x queryEncoder.zip
 rm -rf ../dist
@@ -1,25 +1,9 @@
 from typing import Tuple
-from uuid import uuid4
-from langchain.docstore.document import Document
-from langchain import ConversationChain,PromptTemplate, LLMChain
-from langchain.memory import ConversationBufferMemory, DynamoDBChatMessageHistory,ConversationBufferWindowMemory
-from langchain.prompts import (
-    ChatPromptTemplate, 
-    MessagesPlaceholder, 
-    SystemMessagePromptTemplate, 
-    HumanMessagePromptTemplate
-)
-from langchain.chains import ConversationalRetrievalChain
-from langchain.chat_models import ChatOpenAI
+# Only what every ingestion run needs is imported at module load; PDF parsing and text splitting
+# are imported inside run(), and the OpenSearch credentials are fetched on first use (see secrets_cache.py)
 from langchain.vectorstores import OpenSearchVectorSearch
-from langchain.embeddings import OpenAIEmbeddings
-from langchain.schema import messages_to_dict
-import config   
-from langchain.chains import RetrievalQA
-from langchain.llms import OpenAI
-import requests
-from typing import Dict
-from langchain import PromptTemplate, SagemakerEndpoint
+import embedding_codec
+import secrets_cache
 import json
 import time
 import logging
@@ -37,13 +21,6 @@ DOMAIN_INDEX = "llm_apps_workshop_embeddings"
 DYNAMO_DB_TABLE = os.environ['DynamoDBTableName']
 REGION = os.environ['aws_region']
 
-import boto3
-
-kms = boto3.client('secretsmanager')
-aos_credentials = kms.get_secret_value(SecretId=os.environ['OpenSearchSecret'])
-DOMAIN_ADMIN_UNAME = json.loads(aos_credentials['SecretString'])['username']
-DOMAIN_ADMIN_PW = json.loads(aos_credentials['SecretString'])['password']
-
 
 def run(bucket_: str, key_: str) -> Tuple[str, str]:
     
@@ -86,8 +63,8 @@ def run(bucket_: str, key_: str) -> Tuple[str, str]:
 
         def transform_output(self, output: bytes) -> str:
 
-            response_json = json.loads(output.read().decode("utf-8"))
-            embeddings = response_json["embedding"]
+            # JSON, .npy and float16/base64 responses are all accepted
+            embeddings = embedding_codec.decode_embeddings(output.read())
             if len(embeddings) == 1:
                 return [embeddings[0]]
             return embeddings
@@ -134,7 +111,7 @@ def run(bucket_: str, key_: str) -> Tuple[str, str]:
                                                   texts=chunks,
                                        embedding=embeddings,
                                        opensearch_url=os_domain_ep,
-                                       http_auth=(DOMAIN_ADMIN_UNAME, DOMAIN_ADMIN_PW)   )
+                                       http_auth=secrets_cache.opensearch_credentials()   )
     
     print("docs inserted into opensearch")
 
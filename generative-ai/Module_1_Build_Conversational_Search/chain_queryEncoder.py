@@ -1,31 +1,21 @@
 from typing import Tuple
 from uuid import uuid4
-from langchain.docstore.document import Document
 import os
 
 
-from langchain import ConversationChain,PromptTemplate, LLMChain
-from langchain.memory import ConversationBufferMemory, DynamoDBChatMessageHistory,ConversationBufferWindowMemory
-from langchain.prompts import (PromptTemplate,
-    ChatPromptTemplate, 
-    MessagesPlaceholder, 
-    SystemMessagePromptTemplate, 
-    HumanMessagePromptTemplate
-)
-from langchain.chains import ConversationalRetrievalChain
-from langchain.chat_models import ChatOpenAI
+# Only what every request needs is imported at module load. The chains used by a single search type
+# (RetrievalQA, LLMChain) are imported in their branch, and the OpenSearch credentials are fetched on
+# first use and cached (see secrets_cache.py), so a cold start makes no Secrets Manager call.
+from langchain.memory import ConversationBufferMemory, DynamoDBChatMessageHistory
+from langchain.prompts import PromptTemplate
 from langchain.vectorstores import OpenSearchVectorSearch
-from langchain.embeddings import OpenAIEmbeddings
 from langchain.schema import messages_to_dict
-import config   
-from langchain.chains import RetrievalQA
-from langchain.llms import OpenAI
-import requests
+import embedding_codec
+import secrets_cache
 from typing import Dict
 
-from langchain import PromptTemplate, SagemakerEndpoint
+from langchain import SagemakerEndpoint
 from langchain.llms.sagemaker_endpoint import LLMContentHandler
-from langchain.chains.question_answering import load_qa_chain
 from typing import Any, Dict, Iterable, List, Optional, Tuple, Callable
 import json
 # from langchain.tools import  Tool, tool
@@ -39,13 +29,6 @@ DOMAIN_INDEX = "llm_apps_workshop_embeddings"
 DYNAMO_DB_TABLE = os.environ['DynamoDBTableName']
 REGION = os.environ['aws_region']
 
-import boto3
-
-kms = boto3.client('secretsmanager')
-aos_credentials = kms.get_secret_value(SecretId=os.environ['OpenSearchSecret'])
-DOMAIN_ADMIN_UNAME = json.loads(aos_credentials['SecretString'])['username']
-DOMAIN_ADMIN_PW = json.loads(aos_credentials['SecretString'])['password']
-
 def run(api_key: str, session_id: str, prompt: str) -> Tuple[str, str]:
     """This is the main function that executes the prediction chain.
     Updating this code will change the predictions of the service.
@@ -171,8 +154,8 @@ def run(api_key: str, session_id: str, prompt: str) -> Tuple[str, str]:
 
         def transform_output(self, output: bytes) -> str:
 
-            response_json = json.loads(output.read().decode("utf-8"))
-            embeddings = response_json["embedding"]
+            # JSON, .npy and float16/base64 responses are all accepted
+            embeddings = embedding_codec.decode_embeddings(output.read())
             if len(embeddings) == 1:
                 return [embeddings[0]]
             return embeddings
@@ -194,7 +177,7 @@ def run(api_key: str, session_id: str, prompt: str) -> Tuple[str, str]:
     openSearch_ = SimiliarOpenSearchVectorSearch(index_name=DOMAIN_INDEX,
                                        embedding_function=embeddings,
                                        opensearch_url=os_domain_ep,
-                                       http_auth=(DOMAIN_ADMIN_UNAME, DOMAIN_ADMIN_PW)   ) 
+                                       http_auth=secrets_cache.opensearch_credentials()   ) 
     
     openSearch_retriever = openSearch_.as_retriever()
     # search_type="similarity_score_threshold",
@@ -274,14 +257,6 @@ def run(api_key: str, session_id: str, prompt: str) -> Tuple[str, str]:
         content_handler=content_handler,
     )
 
-    # using STUFF instead of prompt templates
-
-    qa = RetrievalQA.from_chain_type(
-    llm=llm,
-    chain_type="stuff",
-    retriever=openSearch_retriever,
-    memory = memory
-    )
 
     # using prompt templates instead of STUFF
 
@@ -310,9 +285,18 @@ def run(api_key: str, session_id: str, prompt: str) -> Tuple[str, str]:
     else:
         if(searchType_ == "Conversational Search (RAG)"):
             print("OpenSearch and LLM as RAG")
+            # using STUFF instead of prompt templates
+            from langchain.chains import RetrievalQA
+            qa = RetrievalQA.from_chain_type(
+            llm=llm,
+            chain_type="stuff",
+            retriever=openSearch_retriever,
+            memory = memory
+            )
             response = qa.run( json.loads(prompt)["text"])
         else:
             print("Only LLM as generator=true")
+            from langchain import LLMChain
             chain = LLMChain(
                     llm=llm,
                     prompt=PROMPT,
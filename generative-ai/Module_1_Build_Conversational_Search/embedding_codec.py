@@ -0,0 +1,30 @@
+import base64
+import io
+import json
+
+import numpy as np
+
+# Decodes embedding endpoint responses for the ContentHandler classes in the chains. Besides the
+# {"embedding": [...]} JSON response, the encoder can answer with a .npy float32 array or with
+# {"dtype": "float16", "shape": [...], "data": "<base64>"}, which are much smaller for batches.
+
+NPY_MAGIC = b'\x93NUMPY'
+
+
+def decode_embeddings(body: bytes) -> list:
+    if body.startswith(NPY_MAGIC):
+        embeddings = np.load(io.BytesIO(body), allow_pickle=False)
+    else:
+        response_json = json.loads(body.decode("utf-8"))
+        if isinstance(response_json, dict) and response_json.get("dtype") == "float16":
+            data = base64.b64decode(response_json["data"])
+            embeddings = np.frombuffer(data, dtype='<f2').reshape(response_json["shape"])
+        elif isinstance(response_json, dict):
+            return response_json["embedding"]
+        elif response_json and not isinstance(response_json[0], list):
+            return [response_json]
+        else:
+            return response_json
+    if embeddings.ndim == 1:
+        embeddings = embeddings.reshape(1, -1)
+    return embeddings.astype(np.float32).tolist()
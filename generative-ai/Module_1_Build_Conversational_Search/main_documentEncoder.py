@@ -1,12 +1,4 @@
-import json
-import os
-from typing import Dict
-import requests
 import chain_documentEncoder
-import config
-import json
-import urllib.parse
-import boto3
 
 def handler(event, context): 
     
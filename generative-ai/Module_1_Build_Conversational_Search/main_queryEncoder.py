@@ -1,9 +1,6 @@
 import json
-import os
 from typing import Dict
-import requests
 import chain_queryEncoder
-import config
 
 
 def handler(event, context): 
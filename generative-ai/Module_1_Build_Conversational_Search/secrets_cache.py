@@ -0,0 +1,18 @@
+import json
+import os
+from functools import lru_cache
+
+# Secrets Manager lookups for the chain Lambdas. A secret is fetched on first use, not at import, and
+# cached for the life of the execution environment, so only the first invocation pays the round trip.
+
+
+@lru_cache(maxsize=None)
+def get_secret(secret_id):
+    import boto3
+    response = boto3.client('secretsmanager').get_secret_value(SecretId=secret_id)
+    return json.loads(response['SecretString'])
+
+
+def opensearch_credentials():
+    secret = get_secret(os.environ['OpenSearchSecret'])
+    return (secret['username'], secret['password'])
@@ -1,12 +1,14 @@
-import argparse
 import logging
-import sagemaker_containers
-import requests
 
 import os
 import json
 import io
 import time
+import base64
+import hashlib
+import threading
+from collections import Counter, OrderedDict
+import numpy as np
 import torch
 from transformers import AutoTokenizer, AutoModel
 # from sentence_transformers import models, losses, SentenceTransformer
@@ -14,59 +16,546 @@ from transformers import AutoTokenizer, AutoModel
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
+JSON_CONTENT_TYPE = 'application/json'
+JSONLINES_CONTENT_TYPE = 'application/jsonlines'
+TEXT_CONTENT_TYPE = 'text/plain'
+# Binary response formats: a .npy float32 array, or JSON carrying base64 little-endian float16 data
+# as {"dtype": "float16", "shape": [...], "data": "..."}
+NPY_CONTENT_TYPE = 'application/x-npy'
+FLOAT16_JSON_CONTENT_TYPE = 'application/x-float16+json'
+
+# Length bucketing: batches larger than ENCODER_BUCKET_SIZE are sorted by token length and
+# encoded in buckets of that many sentences, each padded only to its own longest sentence
+MAX_LENGTH = int(os.environ.get('ENCODER_MAX_LENGTH', 256))
+LENGTH_BUCKETING = os.environ.get('ENCODER_LENGTH_BUCKETING', 'false').lower() == 'true'
+BUCKET_SIZE = int(os.environ.get('ENCODER_BUCKET_SIZE', 16))
+
+# Set ENCODER_QUANTIZE=int8 to serve the encoder with dynamically quantized Linear layers on CPU
+QUANTIZE = os.environ.get('ENCODER_QUANTIZE', 'none').lower()
+
+# Execution backend: 'eager' runs the Hugging Face model, 'torchscript' and 'onnx' load the graph
+# written into model_dir by export_encoder.py
+BACKEND = os.environ.get('ENCODER_BACKEND', 'eager').lower()
+TORCHSCRIPT_FILE = 'traced_model.pt'
+ONNX_FILE = 'model.onnx'
+
+# In-process LRU cache of sentence embeddings, holding up to ENCODER_CACHE_SIZE vectors (0 disables it)
+CACHE_SIZE = int(os.environ.get('ENCODER_CACHE_SIZE', 0))
+CACHE_STATS_EVERY = int(os.environ.get('ENCODER_CACHE_STATS_EVERY', 1000))
+
+# Optional projection to fewer dimensions with the PCA matrix fitted by fit_projection.py and saved
+# as model_dir/projection.npz, followed by optional L2 normalization. Applies to documents and queries alike.
+PROJECTION = os.environ.get('ENCODER_PROJECTION', 'false').lower() == 'true'
+PROJECTION_FILE = 'projection.npz'
+NORMALIZE = os.environ.get('ENCODER_NORMALIZE', 'false').lower() == 'true'
+
+# Set ENCODER_AUTOCAST=bf16 to run the eager forward pass under bfloat16 CPU autocast; pooling stays fp32
+AUTOCAST = os.environ.get('ENCODER_AUTOCAST', 'none').lower()
+
+# Startup: with ENCODER_OFFLINE=true weights are only read from model_dir, never from the hub, and
+# model.safetensors is memory-mapped instead of unpickled. A warm-up batch of ENCODER_WARMUP_BATCH_SIZE
+# sentences runs before model_fn returns, so the first real request does not pay for lazy initialization.
+OFFLINE = os.environ.get('ENCODER_OFFLINE', 'false').lower() == 'true'
+SAFETENSORS_FILE = 'model.safetensors'
+WARMUP_BATCH_SIZE = int(os.environ.get('ENCODER_WARMUP_BATCH_SIZE', 8))
+# CPU thread topology. ENCODER_INTRA_OP_THREADS defaults to the cores divided evenly between the
+# SAGEMAKER_MODEL_SERVER_WORKERS worker processes, so concurrent workers do not oversubscribe the CPU.
+# When that is unset the model server starts one worker per GPU, or per vCPU on CPU instances, and the
+# same count is assumed. SAGEMAKER_PROGRAM is only set in the serving container, so scripts that call
+# model_fn directly keep torch's default of every core.
+# ENCODER_CPU_AFFINITY optionally pins the workers to a CPU list such as "0-3,8-11"; with several
+# workers the list is split into contiguous slices and every worker is pinned to its own slice.
+MODEL_SERVER_WORKERS = int(os.environ.get('SAGEMAKER_MODEL_SERVER_WORKERS', 0))
+INTRA_OP_THREADS = int(os.environ.get('ENCODER_INTRA_OP_THREADS', 0))
+INTER_OP_THREADS = int(os.environ.get('ENCODER_INTER_OP_THREADS', 1))
+CPU_AFFINITY = os.environ.get('ENCODER_CPU_AFFINITY', '')
+WORKER_SLOT_DIR = os.environ.get('ENCODER_WORKER_SLOT_DIR', '/tmp')
+WARMUP_SENTENCES = ['Does this work with xbox?', 'Can I use this headset with my phone and my laptop at the same time without re-pairing it?']
+
+# Per-stage timing of the hot path (deserialize, tokenize, forward, mean_pooling, predict, serialize)
+# plus batch size and padded sequence length, aggregated into histograms and flushed every
+# ENCODER_METRICS_FLUSH_SECONDS as one CloudWatch EMF line (ENCODER_METRICS_FORMAT=emf) or JSON log line (log)
+METRICS_ENABLED = os.environ.get('ENCODER_METRICS', 'true').lower() == 'true'
+METRICS_FORMAT = os.environ.get('ENCODER_METRICS_FORMAT', 'emf').lower()
+METRICS_FLUSH_SECONDS = float(os.environ.get('ENCODER_METRICS_FLUSH_SECONDS', 60))
+METRICS_NAMESPACE = os.environ.get('ENCODER_METRICS_NAMESPACE', 'SemanticSearch/Encoder')
+METRIC_UNITS = {'batch_size': 'Count', 'padded_length': 'Count'}
+EMF_MAX_VALUES = 100
+
+# Marks sentences that arrived as a batch request, so predict_fn returns one vector per sentence
+# instead of the single vector of the text/plain contract
+class SentenceBatch(list):
+    pass
+
+# Timings are bucketed to two significant digits, which keeps the histogram small whatever the traffic.
+# Count metrics (batch size, padded length) are kept exact, they only take a few distinct values anyway.
+class Histogram(object):
+    def __init__(self, exact=False):
+        self.exact = exact
+        self.counts = Counter()
+
+    def add(self, value):
+        self.counts[value if self.exact else float('%.2g' % value)] += 1
+
+    def percentile(self, q):
+        total = sum(self.counts.values())
+        seen = 0
+        for value in sorted(self.counts):
+            seen += self.counts[value]
+            if seen >= q * total:
+                return value
+        return None
+
+class EncoderMetrics(object):
+    def __init__(self, enabled=METRICS_ENABLED, output_format=METRICS_FORMAT, flush_seconds=METRICS_FLUSH_SECONDS):
+        self.enabled = enabled
+        self.output_format = output_format
+        self.flush_seconds = flush_seconds
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.last_flush = time.time()
+
+    # Stage durations are recorded in milliseconds, everything else as a plain count
+    def record(self, name, value):
+        if not self.enabled:
+            return
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram(exact=METRIC_UNITS.get(name) == 'Count')
+            self.histograms[name].add(value)
+            flush = time.time() - self.last_flush >= self.flush_seconds
+        if flush:
+            self.flush()
+
+    def stage(self, name, start_time):
+        self.record(name, (time.perf_counter() - start_time) * 1000)
+
+    def summary(self):
+        with self.lock:
+            return {name: {'count': sum(h.counts.values()), 'p50': h.percentile(0.5), 'p99': h.percentile(0.99), 'max': max(h.counts)}
+                    for name, h in self.histograms.items()}
+
+    def flush(self):
+        with self.lock:
+            histograms, self.histograms = self.histograms, {}
+            self.last_flush = time.time()
+        if not histograms:
+            return
+        if self.output_format == 'log':
+            logger.info(json.dumps({'encoder_metrics': {name: dict(sorted(h.counts.items())) for name, h in histograms.items()}}))
+            return
+        # EMF takes at most 100 distinct values per metric and record, so larger histograms span several records
+        items = {name: sorted(h.counts.items()) for name, h in histograms.items()}
+        for offset in range(0, max(len(values) for values in items.values()), EMF_MAX_VALUES):
+            chunk = {name: values[offset:offset + EMF_MAX_VALUES] for name, values in items.items() if len(values) > offset}
+            record = {
+                '_aws': {
+                    'Timestamp': int(self.last_flush * 1000),
+                    'CloudWatchMetrics': [{
+                        'Namespace': METRICS_NAMESPACE,
+                        'Dimensions': [[]],
+                        'Metrics': [{'Name': name, 'Unit': METRIC_UNITS.get(name, 'Milliseconds')} for name in chunk],
+                    }],
+                },
+            }
+            for name, values in chunk.items():
+                record[name] = {'Values': [value for value, _ in values], 'Counts': [count for _, count in values]}
+            # EMF records are picked up from stdout by CloudWatch Logs
+            print(json.dumps(record), flush=True)
+
+metrics = EncoderMetrics()
+
 #Mean Pooling - Take attention mask into account for correct averaging
+# The masked sum is one batched matmul ([batch, 1, seq] x [batch, seq, hidden]), so no
+# [batch, seq, hidden] mask or product temporaries are allocated
 def mean_pooling(model_output, attention_mask):
     token_embeddings = model_output[0] #First element of model_output contains all token embeddings
-    input_mask_expanded = attention_mask.unsqueeze(-1).expand(token_embeddings.size()).float()
-    sum_embeddings = torch.sum(token_embeddings * input_mask_expanded, 1)
-    sum_mask = torch.clamp(input_mask_expanded.sum(1), min=1e-9)
+    mask = attention_mask.unsqueeze(1).to(token_embeddings.dtype)
+    sum_embeddings = torch.bmm(mask, token_embeddings).squeeze(1).float()
+    sum_mask = torch.clamp(attention_mask.sum(1, keepdim=True).float(), min=1e-9)
     return sum_embeddings / sum_mask
 
-def embed_tformer(model, tokenizer, sentences):
-    encoded_input = tokenizer(sentences, padding=True, truncation=True, max_length=256, return_tensors='pt')
+def encode_tokens(model, encoded_input):
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    encoded_input.to(device)
+    metrics.record('batch_size', encoded_input['input_ids'].shape[0])
+    metrics.record('padded_length', encoded_input['input_ids'].shape[1])
 
     #Compute token embeddings
-    with torch.no_grad():
+    start_time = time.perf_counter()
+    with torch.inference_mode(), torch.autocast('cpu', dtype=torch.bfloat16, enabled=AUTOCAST == 'bf16' and device.type == 'cpu'):
         model_output = model(**encoded_input)
+    metrics.stage('forward', start_time)
+
+    start_time = time.perf_counter()
+    with torch.inference_mode():
+        sentence_embeddings = mean_pooling(model_output, encoded_input['attention_mask'])
+    metrics.stage('mean_pooling', start_time)
+    return sentence_embeddings
 
-    sentence_embeddings = mean_pooling(model_output, encoded_input['attention_mask'])
+@torch.inference_mode()
+def embed_tformer(model, tokenizer, sentences, bucket_size=None):
+    if bucket_size is None:
+        bucket_size = BUCKET_SIZE if LENGTH_BUCKETING else 0
+    if bucket_size <= 0 or len(sentences) <= bucket_size:
+        start_time = time.perf_counter()
+        encoded_input = tokenizer(sentences, padding=True, truncation=True, max_length=MAX_LENGTH, return_tensors='pt')
+        metrics.stage('tokenize', start_time)
+        return encode_tokens(model, encoded_input)
+
+    # Tokenize once without padding, then pad every length-sorted bucket on its own
+    start_time = time.perf_counter()
+    encoded = tokenizer(sentences, truncation=True, max_length=MAX_LENGTH)
+    metrics.stage('tokenize', start_time)
+    order = sorted(range(len(sentences)), key=lambda i: len(encoded['input_ids'][i]))
+    sentence_embeddings = None
+    for start in range(0, len(order), bucket_size):
+        bucket = order[start:start + bucket_size]
+        encoded_input = tokenizer.pad({key: [encoded[key][i] for i in bucket] for key in encoded.keys()}, return_tensors='pt')
+        bucket_embeddings = encode_tokens(model, encoded_input)
+        if sentence_embeddings is None:
+            sentence_embeddings = bucket_embeddings.new_empty((len(sentences), bucket_embeddings.shape[1]))
+        # Scatter back so results come out in the original request order
+        sentence_embeddings[torch.tensor(bucket, device=bucket_embeddings.device)] = bucket_embeddings
     return sentence_embeddings
 
+# Bounded LRU of pooled vectors stored as float32 arrays. Keys hash the model identity together with
+# the whitespace-normalized text, lowercased when the tokenizer lowercases anyway.
+class EmbeddingCache(object):
+    def __init__(self, max_entries, model_id, lowercase=False, stats_every=CACHE_STATS_EVERY):
+        self.max_entries = max_entries
+        self.model_id = model_id
+        self.lowercase = lowercase
+        self.stats_every = stats_every
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def key(self, sentence):
+        text = ' '.join(sentence.split())
+        if self.lowercase:
+            text = text.lower()
+        return hashlib.sha1((self.model_id + '\0' + text).encode('utf-8')).digest()
+
+    def get(self, key):
+        with self.lock:
+            vector = self.entries.get(key)
+            if vector is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(key)
+            log_stats = self.stats_every > 0 and (self.hits + self.misses) % self.stats_every == 0
+        if log_stats:
+            logger.info('Embedding cache stats: {}'.format(json.dumps(self.stats())))
+        return vector
+
+    def put(self, key, vector):
+        with self.lock:
+            self.entries[key] = vector
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'max_entries': self.max_entries,
+                    'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+class Projection(object):
+    def __init__(self, mean, components):
+        self.mean = mean.astype(np.float32)
+        self.components = np.ascontiguousarray(components.T, dtype=np.float32)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data['mean'], data['components'])
+
+    def __call__(self, embeddings):
+        return (embeddings - self.mean) @ self.components
+
+def l2_normalize(embeddings):
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    return embeddings / np.maximum(norms, 1e-12)
+
+# Dynamic INT8 quantization of the Linear layers, which hold almost all of BERT's weights and FLOPs.
+# Activations stay in fp32 and are quantized on the fly, so no calibration data is needed.
+def quantize_model(nlp_model):
+    return torch.quantization.quantize_dynamic(nlp_model, {torch.nn.Linear}, dtype=torch.qint8)
+
+# Exported graphs take positional inputs in tokenizer.model_input_names order and return a tuple
+# whose first element holds the token embeddings, like the eager model, so mean_pooling is unchanged
+class TorchScriptEncoder(object):
+    def __init__(self, module, input_names):
+        self.module = module
+        self.input_names = input_names
+
+    def __call__(self, **encoded_input):
+        return self.module(*[encoded_input[name] for name in self.input_names])
+
+class OnnxEncoder(object):
+    def __init__(self, model_path):
+        try:
+            import onnxruntime
+        except ImportError:
+            raise Exception('ENCODER_BACKEND=onnx requires onnxruntime, add it to requirements.txt')
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        # Same thread topology as torch, set by configure_threads before the backend is loaded
+        options.intra_op_num_threads = torch.get_num_threads()
+        options.inter_op_num_threads = torch.get_num_interop_threads()
+        providers = [p for p in ['CUDAExecutionProvider', 'CPUExecutionProvider'] if p in onnxruntime.get_available_providers()]
+        self.session = onnxruntime.InferenceSession(model_path, options, providers=providers)
+        self.input_names = [i.name for i in self.session.get_inputs()]
+
+    def __call__(self, **encoded_input):
+        feed = {name: encoded_input[name].cpu().numpy() for name in self.input_names}
+        token_embeddings = torch.from_numpy(self.session.run(None, feed)[0])
+        return (token_embeddings.to(encoded_input['attention_mask'].device),)
+
+def load_exported_encoder(model_dir, tokenizer, device):
+    if BACKEND == 'torchscript':
+        module = torch.jit.load(os.path.join(model_dir, TORCHSCRIPT_FILE), map_location=device)
+        return TorchScriptEncoder(module, tokenizer.model_input_names)
+    if BACKEND == 'onnx':
+        return OnnxEncoder(os.path.join(model_dir, ONNX_FILE))
+    raise Exception('Unsupported ENCODER_BACKEND: {}'.format(BACKEND))
+
+def parse_cpu_list(spec):
+    cpus = set()
+    for part in spec.split(','):
+        if '-' in part:
+            first, last = part.split('-')
+            cpus.update(range(int(first), int(last) + 1))
+        elif part.strip():
+            cpus.add(int(part))
+    return sorted(cpus)
+
+def available_cpus():
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count()
+
+# The model server does not tell a worker its index, so each worker claims the first free slot by
+# holding an exclusive lock on a slot file for its lifetime. A restarted worker reuses the freed slot.
+worker_slot_file = None
+
+def claim_worker_slot(workers, slot_dir=WORKER_SLOT_DIR):
+    global worker_slot_file
+    import fcntl
+    for slot in range(workers):
+        slot_file = open(os.path.join(slot_dir, 'encoder-worker-{}.lock'.format(slot)), 'w')
+        try:
+            fcntl.flock(slot_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            slot_file.close()
+            continue
+        worker_slot_file = slot_file
+        return slot
+    return None
+
+def worker_cpus(cpus, workers, slot):
+    size = len(cpus) // workers
+    if size == 0:
+        return cpus
+    return cpus[slot * size:(slot + 1) * size]
+
+def model_server_workers():
+    if MODEL_SERVER_WORKERS > 0:
+        return MODEL_SERVER_WORKERS
+    if not os.environ.get('SAGEMAKER_PROGRAM'):
+        return 0
+    return torch.cuda.device_count() if torch.cuda.is_available() else available_cpus()
+
+def configure_threads(intra_op_threads=INTRA_OP_THREADS, inter_op_threads=INTER_OP_THREADS, cpus=None):
+    workers = model_server_workers()
+    if cpus is None and CPU_AFFINITY:
+        cpus = parse_cpu_list(CPU_AFFINITY)
+        if workers > 1:
+            slot = claim_worker_slot(workers)
+            if slot is None:
+                logger.warning('No free worker slot out of {}, using the whole CPU list'.format(workers))
+            else:
+                cpus = worker_cpus(cpus, workers, slot)
+                logger.info('Worker slot {} of {}'.format(slot, workers))
+    if cpus:
+        os.sched_setaffinity(0, cpus)
+    if intra_op_threads <= 0:
+        intra_op_threads = max(1, available_cpus() // workers) if workers else torch.get_num_threads()
+    torch.set_num_threads(intra_op_threads)
+    if inter_op_threads > 0 and inter_op_threads != torch.get_num_interop_threads():
+        try:
+            torch.set_num_interop_threads(inter_op_threads)
+        except RuntimeError:
+            # Only allowed once per process, before any inter-op parallel work has started
+            logger.warning('Inter-op threads already initialized, keeping {}'.format(torch.get_num_interop_threads()))
+    logger.info('Thread topology: intra_op={} inter_op={} cpus={}'.format(
+        torch.get_num_threads(), torch.get_num_interop_threads(), cpus or 'all'))
+
+def load_eager_model(model_dir):
+    if not OFFLINE:
+        return AutoModel.from_pretrained(model_dir)
+    if os.path.exists(os.path.join(model_dir, SAFETENSORS_FILE)):
+        return AutoModel.from_pretrained(model_dir, local_files_only=True, use_safetensors=True)
+    logger.warning('No {} in {}, loading pickled weights. Run export_encoder.py --format safetensors for mmap loading'.format(SAFETENSORS_FILE, model_dir))
+    return AutoModel.from_pretrained(model_dir, local_files_only=True)
+
+def warm_up(nlp_model, tokenizer, batch_size):
+    sentences = [WARMUP_SENTENCES[i % len(WARMUP_SENTENCES)] for i in range(batch_size)]
+    embed_tformer(nlp_model, tokenizer, sentences)
+
 def model_fn(model_dir):
     logger.info('model_fn')
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     logger.info(model_dir)
-    tokenizer = AutoTokenizer.from_pretrained("sentence-transformers/bert-base-nli-mean-tokens")
-    nlp_model = AutoModel.from_pretrained("sentence-transformers/bert-base-nli-mean-tokens")
-    nlp_model.to(device)
+    if device.type == 'cpu':
+        configure_threads()
+    startup = {}
+    phase_start = time.time()
+    tokenizer = AutoTokenizer.from_pretrained(model_dir, local_files_only=OFFLINE)
+    startup['tokenizer'] = time.time() - phase_start
+
+    phase_start = time.time()
+    if BACKEND != 'eager':
+        logger.info('Loading exported {} encoder'.format(BACKEND))
+        nlp_model = load_exported_encoder(model_dir, tokenizer, device)
+    else:
+        nlp_model = load_eager_model(model_dir)
+        nlp_model.to(device)
+    startup['model'] = time.time() - phase_start
+
+    if QUANTIZE == 'int8' and BACKEND != 'eager':
+        raise Exception('ENCODER_QUANTIZE=int8 is only supported with ENCODER_BACKEND=eager')
+    if QUANTIZE == 'int8':
+        phase_start = time.time()
+        if device.type == 'cpu':
+            logger.info('Applying dynamic INT8 quantization to Linear layers')
+            nlp_model = quantize_model(nlp_model)
+        else:
+            logger.warning('ENCODER_QUANTIZE=int8 is only supported on CPU, serving fp32 on {}'.format(device))
+        startup['quantize'] = time.time() - phase_start
+    elif QUANTIZE != 'none':
+        raise Exception('Unsupported ENCODER_QUANTIZE: {}'.format(QUANTIZE))
+
+    if WARMUP_BATCH_SIZE > 0:
+        phase_start = time.time()
+        warm_up(nlp_model, tokenizer, WARMUP_BATCH_SIZE)
+        startup['warmup'] = time.time() - phase_start
+
     model = {'model':nlp_model, 'tokenizer':tokenizer}
+    if PROJECTION:
+        model['projection'] = Projection.load(os.path.join(model_dir, PROJECTION_FILE))
+        logger.info('Projecting embeddings to {} dimensions'.format(model['projection'].components.shape[1]))
+    if CACHE_SIZE > 0:
+        model_id = '{}:{}:{}:{}:{}:{}'.format(model_dir, BACKEND, QUANTIZE, MAX_LENGTH, PROJECTION, NORMALIZE)
+        model['cache'] = EmbeddingCache(CACHE_SIZE, model_id, lowercase=getattr(tokenizer, 'do_lower_case', False))
+    startup['total'] = sum(startup.values())
+    logger.info('Startup seconds per phase: {}'.format(json.dumps({phase: round(seconds, 3) for phase, seconds in startup.items()})))
 
-#     model = SentenceTransformer(model_dir + '/transformer/')
-#     logger.info(model)
     return model
 
 # Deserialize the Invoke request body into an object we can perform prediction on
-def input_fn(serialized_input_data, content_type='text/plain'):
+#   text/plain             -> one sentence, answered with one vector
+#   application/json       -> JSON array of sentences, answered with one vector per sentence
+#   application/jsonlines  -> one JSON string per line, answered with one vector per sentence
+def input_fn(serialized_input_data, content_type=TEXT_CONTENT_TYPE):
     logger.info('Deserializing the input data.')
+    start_time = time.perf_counter()
+    sentences = parse_input(serialized_input_data, content_type)
+    metrics.stage('deserialize', start_time)
+    return sentences
+
+def parse_input(serialized_input_data, content_type):
+    mime_type = (content_type or TEXT_CONTENT_TYPE).split(';')[0].strip().lower()
     try:
-        data = [serialized_input_data.decode('utf-8')]
-        return data
-    except:
-        raise Exception('Requested unsupported ContentType in content_type: {}'.format(content_type))
+        body = serialized_input_data.decode('utf-8') if isinstance(serialized_input_data, bytes) else serialized_input_data
+    except UnicodeDecodeError:
+        raise Exception('Request body is not valid utf-8 for ContentType: {}'.format(content_type))
+
+    if mime_type == JSON_CONTENT_TYPE:
+        sentences = json.loads(body)
+        if isinstance(sentences, str):
+            return [sentences]
+    elif mime_type == JSONLINES_CONTENT_TYPE:
+        sentences = [json.loads(line) for line in body.splitlines() if line.strip()]
+    else:
+        # Any other content type (text/plain, or application/octet-stream from the SDK v2 default
+        # serializer) is the original single-sentence contract
+        return [body]
+
+    if not isinstance(sentences, list) or not all(isinstance(sentence, str) for sentence in sentences):
+        raise Exception('Batch requests must be a list of strings for ContentType: {}'.format(content_type))
+    return SentenceBatch(sentences)
+
+# The whole batch goes through a single padded forward pass
+def encode_sentences(sentences, model):
+    sentence_embeddings = embed_tformer(model['model'], model['tokenizer'], sentences)
+    sentence_embeddings = sentence_embeddings.cpu().numpy().astype(np.float32, copy=False)
+    if 'projection' in model:
+        sentence_embeddings = model['projection'](sentence_embeddings)
+    if NORMALIZE:
+        sentence_embeddings = l2_normalize(sentence_embeddings)
+    return sentence_embeddings
+
+# Only the sentences missing from the cache are encoded; cached rows are filled in afterwards
+def encode_with_cache(sentences, model, cache):
+    keys = [cache.key(sentence) for sentence in sentences]
+    vectors = [cache.get(key) for key in keys]
+    # Repeated sentences within one request are encoded once
+    misses = OrderedDict()
+    for i, vector in enumerate(vectors):
+        if vector is None:
+            misses.setdefault(keys[i], []).append(i)
+    if misses:
+        encoded = encode_sentences([sentences[rows[0]] for rows in misses.values()], model)
+        for (key, rows), vector in zip(misses.items(), encoded):
+            vector = vector.copy()
+            cache.put(key, vector)
+            for i in rows:
+                vectors[i] = vector
+    return np.stack(vectors)
 
 # Perform prediction on the deserialized object, with the loaded model
 def predict_fn(input_object, model):
     logger.info("Calling model")
-    start_time = time.time()
-    sentence_embeddings = embed_tformer(model['model'], model['tokenizer'], input_object)
-    print("--- Inference time: %s seconds ---" % (time.time() - start_time))
-    response = sentence_embeddings[0].tolist()
-    return response
+    if len(input_object) == 0:
+        return np.empty((0, 0), dtype=np.float32)
+    start_time = time.perf_counter()
+    if 'cache' in model:
+        sentence_embeddings = encode_with_cache(input_object, model, model['cache'])
+    else:
+        sentence_embeddings = encode_sentences(input_object, model)
+    metrics.stage('predict', start_time)
+    # Batches come back as a [sentences, dim] float32 array, single sentences as a [dim] vector
+    if isinstance(input_object, SentenceBatch):
+        return sentence_embeddings
+    return sentence_embeddings[0]
 
 # Serialize the prediction result into the desired response content type
 def output_fn(prediction, accept):
     logger.info('Serializing the generated output.')
-    if accept == 'application/json':
-        output = json.dumps(prediction)
+    start_time = time.perf_counter()
+    output = serialize_output(prediction, accept)
+    metrics.stage('serialize', start_time)
+    return output
+
+def serialize_output(prediction, accept):
+    mime_type = (accept or JSON_CONTENT_TYPE).split(';')[0].strip().lower()
+    if mime_type == JSON_CONTENT_TYPE:
+        output = json.dumps(prediction.tolist())
         return output
-    raise Exception('Requested unsupported ContentType in Accept: {}'.format(content_type))
+    if mime_type == NPY_CONTENT_TYPE:
+        buffer = io.BytesIO()
+        np.save(buffer, prediction.astype(np.float32, copy=False))
+        return buffer.getvalue()
+    if mime_type == FLOAT16_JSON_CONTENT_TYPE:
+        return json.dumps({
+            'dtype': 'float16',
+            'shape': list(prediction.shape),
+            'data': base64.b64encode(prediction.astype('<f2').tobytes()).decode('ascii'),
+        })
+    raise Exception('Requested unsupported ContentType in Accept: {}'.format(accept))
@@ -0,0 +1,279 @@
+import argparse
+import itertools
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+import convert_pqa
+import inference
+
+# End-to-end ingestion of raw Amazon PQA files into the nlp_pqa kNN index:
+#   read -> batch-encode questions with inference.embed_tformer -> build _bulk body -> parallel _bulk
+# At most --max-in-flight bulk requests are outstanding; reading and encoding block until one completes.
+# Progress is checkpointed per input file, so an interrupted run resumes after the last record whose
+# bulk request was acknowledged with no rejected items, and docs/sec is reported for every stage.
+#
+#   python ingest_pqa.py amazon-pqa/amazon_pqa_*.json.gz --model-dir transformer \
+#       --endpoint https://<domain-endpoint> --user master --password <password> --create-index
+#
+# Pointing --endpoint at fake_bulk_endpoint.py exercises the whole pipeline without a cluster.
+
+RETRY_STATUS = {429, 502, 503, 504}
+
+
+def knn_index_body(dimension):
+    return {
+        'settings': {'index.knn': True, 'index.knn.space_type': 'cosinesimil'},
+        'mappings': {
+            'properties': {
+                'question_vector': {'type': 'knn_vector', 'dimension': dimension, 'store': True},
+                'question': {'type': 'text', 'store': True},
+                'answer': {'type': 'text', 'store': True},
+                # Tie-breaker of the search Lambda's search_after pagination
+                'question_id': {'type': 'keyword'},
+            }
+        }
+    }
+
+
+class Checkpoint(object):
+    # Records per input file whose bulk requests have all been acknowledged. Batches finish out of
+    # order, so only the contiguous prefix of completed batches moves the checkpoint forward.
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.done = {}
+        self.pending = {}
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self.done = json.load(f)
+
+    def start(self, input_path):
+        return self.done.get(input_path, 0)
+
+    def complete(self, input_path, start, end):
+        with self.lock:
+            pending = self.pending.setdefault(input_path, {})
+            pending[start] = end
+            done = self.done.get(input_path, 0)
+            while done in pending:
+                done = pending.pop(done)
+            self.done[input_path] = done
+            self.save()
+
+    def save(self):
+        if not self.path:
+            return
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.done, f)
+        os.replace(tmp_path, self.path)
+
+
+class StageTimer(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.seconds = {}
+        self.docs = {}
+
+    def add(self, stage, seconds, docs):
+        with self.lock:
+            self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+            self.docs[stage] = self.docs.get(stage, 0) + docs
+
+    def report(self):
+        return {stage: {'docs': self.docs[stage], 'seconds': round(self.seconds[stage], 3),
+                        'docs_per_second': round(self.docs[stage] / self.seconds[stage], 1) if self.seconds[stage] else None}
+                for stage in self.seconds}
+
+
+class BulkClient(object):
+    def __init__(self, endpoint, auth=None, max_retries=5, timeout=60):
+        self.url = endpoint.rstrip('/') + '/_bulk'
+        self.endpoint = endpoint.rstrip('/')
+        self.auth = auth
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def session(self):
+        # One keep-alive session per sender thread
+        if not hasattr(self.local, 'session'):
+            self.local.session = requests.Session()
+            self.local.session.auth = self.auth
+        return self.local.session
+
+    def create_index(self, index_name, body):
+        response = self.session().put('{}/{}'.format(self.endpoint, index_name), json=body, timeout=self.timeout)
+        if response.status_code not in (200, 400):
+            response.raise_for_status()
+
+    # Bumps the generation counter in the mapping _meta. The search Lambda keys its response cache on
+    # it, so cached results for the previous contents of the index stop being served.
+    def bump_generation(self, index_name):
+        response = self.session().get('{}/{}/_mapping'.format(self.endpoint, index_name), timeout=self.timeout)
+        response.raise_for_status()
+        meta = next(iter(response.json().values()))['mappings'].get('_meta', {})
+        generation = int(meta.get('generation', 0)) + 1
+        response = self.session().put('{}/{}/_mapping'.format(self.endpoint, index_name), timeout=self.timeout,
+                                      json={'_meta': dict(meta, generation=generation)})
+        response.raise_for_status()
+        return generation
+
+    # Sends one _bulk body, retrying throttled requests and throttled items with exponential backoff.
+    # Returns the ids of items that failed with a non-retryable status.
+    def send(self, entries):
+        failed = []
+        for attempt in range(self.max_retries + 1):
+            response = self.session().post(self.url, data=b''.join(entries), timeout=self.timeout,
+                                           headers={'Content-Type': 'application/x-ndjson'})
+            if response.status_code in RETRY_STATUS and attempt < self.max_retries:
+                time.sleep(2 ** attempt * 0.1)
+                continue
+            response.raise_for_status()
+            result = response.json()
+            if not result.get('errors'):
+                return failed
+            retry = []
+            for entry, item in zip(entries, result['items']):
+                item = next(iter(item.values()))
+                status = item.get('status', 200)
+                if status in RETRY_STATUS:
+                    retry.append(entry)
+                elif status >= 300:
+                    failed.append(item.get('_id'))
+            if not retry:
+                return failed
+            entries = retry
+            time.sleep(2 ** attempt * 0.1)
+        raise Exception('Bulk request still throttled after {} retries'.format(self.max_retries))
+
+
+def read_batches(path, start, batch_size, limit=None):
+    records = itertools.islice(convert_pqa.read_records(path), start, limit)
+    offset = start
+    while True:
+        batch = list(itertools.islice(records, batch_size))
+        if not batch:
+            return
+        yield offset, offset + len(batch), batch
+        offset += len(batch)
+
+
+def build_entries(records, vectors, index_name):
+    entries = []
+    for record, vector in zip(records, vectors):
+        document = dict(convert_pqa.to_document(record), question_vector=vector.tolist())
+        entries.append(convert_pqa.bulk_entry(convert_pqa.bulk_action(record, index_name), document))
+    return entries
+
+
+def ingest(paths, model, client, index_name, checkpoint, batch_size, max_in_flight, limit=None):
+    timer = StageTimer()
+    in_flight = threading.BoundedSemaphore(max_in_flight)
+    totals = {'indexed': 0, 'failed': 0, 'skipped': 0, 'failed_ids': []}
+    totals_lock = threading.Lock()
+
+    def send(path, start, end, entries):
+        try:
+            start_time = time.perf_counter()
+            failed = client.send(entries)
+            timer.add('bulk', time.perf_counter() - start_time, len(entries))
+            with totals_lock:
+                totals['indexed'] += len(entries) - len(failed)
+                totals['failed'] += len(failed)
+                totals['failed_ids'].extend(failed)
+            # A batch with rejected items is not checkpointed, so a resumed run sends it again (ids are
+            # stable, the acknowledged items are overwritten) instead of silently skipping the failures
+            if not failed:
+                checkpoint.complete(path, start, end)
+        finally:
+            in_flight.release()
+
+    # Raises the error of the first bulk request that failed permanently, before more batches are sent
+    def check(futures):
+        for future in [future for future in futures if future.done()]:
+            future.result()
+            futures.remove(future)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        futures = []
+        for path in paths:
+            batches = read_batches(path, checkpoint.start(path), batch_size, limit)
+            while True:
+                start_time = time.perf_counter()
+                batch = next(batches, None)
+                if batch is None:
+                    break
+                start, end, records = batch
+                records = [record for record in records if convert_pqa.to_document(record) is not None]
+                timer.add('read', time.perf_counter() - start_time, len(records))
+                totals['skipped'] += end - start - len(records)
+
+                entries = []
+                if records:
+                    start_time = time.perf_counter()
+                    vectors = inference.encode_sentences([record['question_text'] for record in records], model)
+                    timer.add('encode', time.perf_counter() - start_time, len(records))
+
+                    start_time = time.perf_counter()
+                    entries = build_entries(records, vectors, index_name)
+                    timer.add('build', time.perf_counter() - start_time, len(entries))
+
+                if not entries:
+                    checkpoint.complete(path, start, end)
+                    continue
+                check(futures)
+                # Backpressure: wait here while max_in_flight bulk requests are outstanding
+                in_flight.acquire()
+                check(futures)
+                futures.append(executor.submit(send, path, start, end, entries))
+        for future in futures:
+            future.result()
+
+    elapsed = time.perf_counter() - started
+    return dict(totals, seconds=round(elapsed, 3), docs_per_second=round(totals['indexed'] / elapsed, 1) if elapsed else None,
+                stages=timer.report())
+
+
+def http_auth(args):
+    if args.aws_region:
+        import boto3
+        from requests_aws4auth import AWS4Auth
+        credentials = boto3.session.Session().get_credentials()
+        return AWS4Auth(credentials.access_key, credentials.secret_key, args.aws_region, 'es', session_token=credentials.token)
+    if args.user:
+        return (args.user, args.password)
+    return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('inputs', nargs='+')
+    parser.add_argument('--model-dir', required=True)
+    parser.add_argument('--endpoint', required=True, help='OpenSearch URL, e.g. https://<domain-endpoint>')
+    parser.add_argument('--index', default=convert_pqa.INDEX_NAME)
+    parser.add_argument('--user')
+    parser.add_argument('--password')
+    parser.add_argument('--aws-region', help='sign requests with SigV4 instead of basic auth')
+    parser.add_argument('--batch-size', type=int, default=256, help='records encoded and sent per _bulk request')
+    parser.add_argument('--max-in-flight', type=int, default=4)
+    parser.add_argument('--checkpoint', default='ingest_pqa.checkpoint.json')
+    parser.add_argument('--limit', type=int, help='records read from each input file')
+    parser.add_argument('--create-index', action='store_true')
+    args = parser.parse_args()
+
+    model = inference.model_fn(args.model_dir)
+    client = BulkClient(args.endpoint, http_auth(args))
+    if args.create_index:
+        dimension = inference.encode_sentences(['dimension probe'], model).shape[1]
+        client.create_index(args.index, knn_index_body(dimension))
+    result = ingest(args.inputs, model, client, args.index, Checkpoint(args.checkpoint), args.batch_size, args.max_in_flight, args.limit)
+    if result['indexed']:
+        result['generation'] = client.bump_generation(args.index)
+    print(json.dumps(result, indent=2))
@@ -0,0 +1,93 @@
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+
+# Cold-start budget for the Lambda entry points. Each target module is imported in fresh interpreters
+# with -X importtime; the report gives the median module init time and the imports that cost the most.
+# It doubles as a regression check and exits non-zero when a target is over its budget. The default
+# budgets are the medians measured on a 1 vCPU machine (search ~400 ms, query handler ~1.6 s, document
+# handler ~0.8 s with langchain installed) plus about 50%; --max-init-ms sets one budget for every target.
+#
+#   python profile_cold_start.py --runs 5
+#
+# Entry points read their settings from the environment at import, so placeholder values are set here.
+# Creating boto3 clients does not need credentials, and nothing may make a network call at import.
+# A target that needs an optional package which is not installed here (langchain for the conversational
+# search handlers) is reported as skipped; any other import error fails the check.
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+CHAIN_DIR = os.path.join(ROOT, 'generative-ai', 'Module_1_Build_Conversational_Search')
+TARGETS = {
+    'search': (os.path.join(ROOT, 'backend', 'lambda'), 'app', 600),
+    'query_handler': (CHAIN_DIR, 'main_queryEncoder', 2500),
+    'document_handler': (CHAIN_DIR, 'main_documentEncoder', 1200),
+}
+OPTIONAL_PACKAGES = {'langchain'}
+PLACEHOLDER_ENV = {
+    'AWS_REGION': 'us-east-1', 'AWS_DEFAULT_REGION': 'us-east-1', 'aws_region': 'us-east-1',
+    'ES_ENDPOINT': 'localhost', 'SM_ENDPOINT': 'encoder',
+    'EmbeddingEndpointName': 'embedding', 'LLMEndpointName': 'llm', 'OpenSearchDomainEndpoint': 'localhost',
+    'DynamoDBTableName': 'conversation-history-store', 'OpenSearchSecret': 'opensearch-secret',
+}
+PROBE = 'import time; start = time.perf_counter(); import {module}; print((time.perf_counter() - start) * 1000)'
+
+def parse_importtime(stderr):
+    # Lines look like "import time:   self [us] | cumulative | <indent>package"
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        imports.append({'module': name.strip(), 'depth': (len(name) - len(name.lstrip())) // 2,
+                        'self_ms': int(self_us) / 1000.0, 'cumulative_ms': int(cumulative_us) / 1000.0})
+    return imports
+
+def profile(directory, module, runs, top):
+    env = dict(os.environ, **{k: v for k, v in PLACEHOLDER_ENV.items() if k not in os.environ})
+    env['PYTHONPATH'] = directory
+    init_ms = []
+    imports = []
+    for _ in range(runs):
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', PROBE.format(module=module)],
+                                cwd=directory, env=env, capture_output=True, text=True)
+        if result.returncode != 0:
+            error = result.stderr.strip().splitlines()[-1]
+            missing = re.match(r"ModuleNotFoundError: No module named '([^'.]+)", error)
+            if missing and missing.group(1) in OPTIONAL_PACKAGES:
+                return {'skipped': error}
+            return {'error': error}
+        init_ms.append(float(result.stdout.strip().splitlines()[-1]))
+        imports = parse_importtime(result.stderr)
+    target = next((item for item in imports if item['module'] == module), None)
+    # Direct imports of the target module plus its own body, which includes clients created at import
+    children = [item for item in imports if item['depth'] == 1]
+    return {
+        'init_ms': round(statistics.median(init_ms), 1),
+        'runs': runs,
+        'module_body_ms': round(target['self_ms'], 1) if target else None,
+        'top_imports': [{'module': item['module'], 'cumulative_ms': round(item['cumulative_ms'], 1)}
+                        for item in sorted(children, key=lambda item: -item['cumulative_ms'])[:top]],
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--targets', nargs='+', choices=sorted(TARGETS), default=sorted(TARGETS))
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=10)
+    parser.add_argument('--max-init-ms', type=float, help='fail when a target median init time is above this '
+                                                          '(default: the per-target budget in TARGETS)')
+    args = parser.parse_args()
+
+    report = {name: profile(TARGETS[name][0], TARGETS[name][1], args.runs, args.top) for name in args.targets}
+    for name, result in report.items():
+        if 'init_ms' in result:
+            result['budget_ms'] = args.max_init_ms if args.max_init_ms is not None else TARGETS[name][2]
+    failed = [name for name, result in report.items()
+              if 'error' in result or ('init_ms' in result and result['init_ms'] > result['budget_ms'])]
+    report['passed'] = not failed
+    print(json.dumps(report, indent=2))
+    sys.exit(1 if failed else 0)